@@ -102,6 +102,25 @@ def namedrecord(name, elements):
         
     return type(name, (object,), dict(__slots__=list(elements), __init__=__init__, __repr__=__repr__))
 
+def morton(coords):
+    """
+    Gives the position of 2D integer co-ordinates along a Z-order
+    (Morton) curve. Sorting by this keeps nearby co-ordinates close
+    together, and all co-ordinates in any aligned power of two
+    square are kept next to each other.
+    """
+    
+    def spread(v):
+        v = (v + (1 << 31)) & 0xffffffff
+        v = (v | (v << 16)) & 0x0000ffff0000ffff
+        v = (v | (v << 8)) & 0x00ff00ff00ff00ff
+        v = (v | (v << 4)) & 0x0f0f0f0f0f0f0f0f
+        v = (v | (v << 2)) & 0x3333333333333333
+        v = (v | (v << 1)) & 0x5555555555555555
+        return v
+    
+    return spread(coords[0]) | (spread(coords[1]) << 1)
+
 def extend(iterable, n=None):
     """
     Extends an iterable by repeating the last value up to
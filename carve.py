@@ -1,6 +1,6 @@
 """ Masks areas to be carved out based on contour """
 
-import itertools
+import itertools, collections
 import numpy, scipy.interpolate, numpy.random
 import vec
 
@@ -13,6 +13,54 @@ river_frequency_centre = 5.1
 river_frequency_width = 2.8
 
 
+class Cache(object):
+    """
+    Holds on to a limited number of the most recently used
+    results along with counts of how many lookups found them.
+    """
+    
+    def __init__(self, limit):
+        self.limit = limit
+        self.__entries = collections.OrderedDict()  # Keys map to results in order of use
+        self.hits = 0
+        self.misses = 0
+        
+    def __len__(self):
+        return len(self.__entries)
+    
+    def get(self, key, make):
+        """
+        Returns the result stored for the key, calling 'make' to
+        produce it if it isn't present.
+        """
+        
+        try:
+            result = self.__entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            result = make()
+            if isinstance(result, numpy.ndarray):
+                result.flags.writeable = False
+            while self.__entries and len(self.__entries) >= self.limit:
+                self.__entries.popitem(last=False)
+        else:
+            self.hits += 1
+            
+        self.__entries[key] = result
+        return result
+    
+    def clear(self):
+        self.__entries.clear()
+
+mask_cache = Cache(1024)    # Masks of edges carved without a seed
+series_cache = Cache(4096)  # Meander series, shared by the chunks on either side of an edge
+
+def cache_counts():
+    """ Hit and miss counts of the mask and series caches """
+    
+    return numpy.array([mask_cache.hits, mask_cache.misses, series_cache.hits, series_cache.misses])
+
+
 class ChunkSeed(object):
     """
     Used to seed generation of chunk specific features such
@@ -58,6 +106,8 @@ class Meander(object):
     fraction of the full range.
     """
     
+    __weights = {}  # Interpolation weights for each series length and step
+    
     def __init__(self, seed, step, range=(-1, 1), final_precision=0.05):
         self.seed = seed
         self.step = step
@@ -73,12 +123,19 @@ class Meander(object):
         # Numpy now enforces mtrand 32-bit seed integer restriction
         self._seed = val & 0xffffffff
     
+    def __key(self, *args):
+        # Generated values only depend on these settings
+        return (tuple(numpy.ravel(self.seed).tolist()), self.step, tuple(self.range), self.final_precision) + args
+    
     def first(self):
         """
         Return value of the first point of the generated
         series.
         """
         
+        return series_cache.get(self.__key(), self.__first)
+    
+    def __first(self):
         gen = numpy.random.mtrand.RandomState(self.seed)
         return int(numpy.round(gen.uniform(self.range[0], self.range[1], 1)[0]))
         
@@ -88,30 +145,57 @@ class Meander(object):
         values. If a 'final' vale is supplied then the last
         value in the returned series will match this value to
         within the precision specified by 'final_precision'.
+        The returned series must not be modified.
         """
         
-        # Get the source random samples
-        source_points = int(numpy.ceil(float(points)/self.step))
+        return series_cache.get(self.__key(points, final), lambda: self.__series(points, final))
+    
+    def weights(self, points):
+        """
+        Matrix giving the interpolated series from the source
+        random samples. The cubic interpolation is linear in the
+        samples so it only needs to be found once for each series
+        length and step.
+        """
         
-        gen = numpy.random.mtrand.RandomState(self.seed)
-        y1 = gen.uniform(self.range[0], self.range[1], source_points)
+        key = (points, self.step)
+        try:
+            return self.__weights[key]
+        except KeyError:
+            pass
+        
+        source_points = int(numpy.ceil(float(points)/self.step))
         #x1 = numpy.linspace(-(float(source_points) % step), float(points) - 1, source_points)
         x1 = numpy.linspace(0, float(points) + float(source_points) % self.step - 1, source_points)
+        x2 = numpy.linspace(0.0, float(points) - 1, points)
+        weights = scipy.interpolate.interp1d(x1, numpy.identity(source_points), kind='cubic', axis=0)(x2)
+        
+        self.__weights[key] = weights
+        return weights
+    
+    def __series(self, points, final):
+        weights = self.weights(points)
         
-        # Adjust final sample to meet required result
+        # Get the source random samples
+        gen = numpy.random.mtrand.RandomState(self.seed)
+        y1 = gen.uniform(self.range[0], self.range[1], weights.shape[1])
+        
+        # Adjust final sample to meet required result, each adjustment
+        # changes the last point by a fixed fraction of the error
         if final is not None:
             accept = abs(self.range[1] - self.range[0])*self.final_precision
+            rest = numpy.dot(weights[-1, :-1], y1[:-1])
+            last, scale = y1[-1], weights[-1, -1]
             for i in xrange(0, 20): # Really shouldn't go deeper than this but let's be sure
-                f = scipy.interpolate.interp1d(x1, y1, kind='cubic')
-                error = final - f(float(points) - 1)
+                error = final - (rest + scale*last)
                 if abs(error) < accept:
                     break
                 else:
-                   y1[-1] = y1[-1] + error 
+                    last = last + error
+            y1[-1] = last
         
         # Find interpolated points
-        x2 = numpy.linspace(0.0, float(points) - 1, points)
-        y2 = scipy.interpolate.interp1d(x1, y1, kind='cubic')(x2)
+        y2 = numpy.dot(weights, y1)
         
         return numpy.cast[int](numpy.round(y2))
 
@@ -141,24 +225,26 @@ def river_shore(shape, seed, base_width, v):
 def trace_ellipse(centre, axes, bound=((0, 0), (15, 15))):
     """
     Trace the pixels of a quadrant of a specified ellipse
-    constrained to within a given window.
+    constrained to within a given window. Returns an array
+    with the outermost point inside the ellipse for each
+    step along the first axis.
     """
     
-    # Ellipse interior checking function
     abs_axes = numpy.abs(numpy.array(axes)) - corner_radius_offset
     ax2, az2 = numpy.power(abs_axes, 2)
-    in_ellipse = lambda x, z: (float(x)**2/ax2 + float(z)**2/az2 < 1)
-    
-    # Step through possible points until we find one in ellipse
-    upper = int(numpy.floor(abs_axes[1]))
-    for x in xrange(0, int(numpy.floor(abs_axes[0])) + 1):
-        for z in xrange(upper, -1, -1):
-            if in_ellipse(x, z):
-                upper = z
-                point = numpy.cast[int](centre + numpy.sign(axes)*numpy.array([x, z]))
-                if (numpy.array(bound[0]) <= point).all() and (numpy.array(bound[1]) >= point).all():
-                    yield point
-                break
+    xs = numpy.arange(0, int(numpy.floor(abs_axes[0])) + 1)
+    zs = numpy.arange(0, int(numpy.floor(abs_axes[1])) + 1)
+    if not len(xs) or not len(zs):
+        return numpy.zeros((0, 2), int)
+    
+    # Find the quadrant interior and the last point inside it on each line
+    inside = numpy.cast[float](xs[:, numpy.newaxis])**2/ax2 + numpy.cast[float](zs)**2/az2 < 1
+    found = inside.any(axis=1)
+    upper = len(zs) - 1 - numpy.argmax(inside[:, ::-1], axis=1)
+    
+    points = numpy.cast[int](centre + numpy.sign(axes)*numpy.column_stack((xs, upper))[found])
+    within = ((numpy.array(bound[0]) <= points) & (numpy.array(bound[1]) >= points)).all(axis=1)
+    return points[within]
 
 def mask_square(shape, inner, outer):
     """
@@ -167,29 +253,29 @@ def mask_square(shape, inner, outer):
     """
     
     a = numpy.zeros(shape, dtype=bool)
-    mx, my = shape
-    for x in xrange(inner[0], outer[0]):
-        a.data[mx*x+inner[1]:mx*x+outer[1]] = '\x01'*(outer[1] - inner[1])
+    a[inner[0]:outer[0], inner[1]:outer[1]] = True
         
     return a
 
 def mask_lines(shape, limits, start=0, step=1):
     """
-    Accepts a list of tuples with (start, end) horizontal
-    ranges. Start from specified x coordinate.
+    Accepts a sequence of (start, end) horizontal ranges,
+    one for each line starting from the specified x
+    coordinate. Lines past the edge are dropped.
     """
     
     a = numpy.zeros(shape, dtype=bool)
     mx, my = shape
     
-    x = start
-    for line in limits:
-        if x < 0 or x >= mx:
-            break
-        start = my if line[0] > my else line[0]
-        end   = my if line[1] > my else line[1]
-        a.data[mx*x+start:mx*x+end] = '\x01'*(end - start)
-        x += step
+    # Only keep the lines up to the first one that is out of bounds
+    limits = numpy.minimum(numpy.asarray(limits, int).reshape(-1, 2), my)
+    xs = start + step*numpy.arange(len(limits))
+    outside = (xs < 0) | (xs >= mx)
+    if outside.any():
+        limits, xs = limits[:numpy.argmax(outside)], xs[:numpy.argmax(outside)]
+    
+    ys = numpy.arange(my)
+    a[xs] = (ys >= limits[:, 0:1]) & (ys < limits[:, 1:2])
         
     return a
 
@@ -235,12 +321,26 @@ def get_features(edge):
     
     return straights, concave, convex
 
+EdgeFeatures = collections.namedtuple('EdgeFeatures', 'straights concave convex components')
+
+def _edge_features(edge):
+    """ Find the features of a direction mask as direction masks """
+    
+    straights, concave, convex = get_features(vec.mask2vecs(edge))
+    components = itertools.chain.from_iterable(vec.decompose(v) for v in itertools.chain(straights, concave, convex))
+    return EdgeFeatures(*(vec.dirs2mask(vec.vecs2tuples(x)) for x in (straights, concave, convex, components)))
+
+# Features of every possible edge direction mask
+edge_features = [_edge_features(edge) for edge in xrange(0, 1 << len(vec.directions))]
+
 def mask_edge(shape, v, widths):
     """ Create mask for one side of an area out of a sequence of widths """
     
     axis = 0 if v[0] != 0 else 1
-    limits = ((0, x) for x in widths) if any(v < 0) else ((shape[axis] - x, shape[axis]) for x in widths)
-    vert = mask_lines(shape, limits)
+    widths = numpy.asarray(widths, int)[:shape[0], numpy.newaxis]
+    across = numpy.arange(shape[1])
+    vert = numpy.zeros(shape, dtype=bool)
+    vert[:len(widths)] = across < widths if any(v < 0) else across >= shape[axis] - widths
     return vert.T if axis == 0 else vert
 
 def mask_concave_corner(shape, v, widths):
@@ -249,7 +349,7 @@ def mask_concave_corner(shape, v, widths):
     centre = (v+1)/2 * (numpy.array(shape) - 1)
     sign = numpy.sign(v)
     ellipse = trace_ellipse(centre, -sign*widths, (numpy.zeros(len(shape), int), numpy.array(shape) - 1))
-    limits = (numpy.sort([centre[1], z]) + numpy.array([0, 1]) for x, z in ellipse)
+    limits = numpy.column_stack((numpy.minimum(centre[1], ellipse[:, 1]), numpy.maximum(centre[1], ellipse[:, 1]) + 1))
     return mask_lines(shape, limits, centre[0], -sign[0])
 
 def mask_convex_corner(shape, v, widths):
@@ -258,19 +358,20 @@ def mask_convex_corner(shape, v, widths):
     corner = (v+1)/2 * (numpy.array(shape) - 1)
     sign = numpy.sign(v)
     centre = corner + sign - 2*sign*widths
-    ellipse = list(trace_ellipse(centre, sign*widths, (numpy.zeros(len(shape), int), numpy.array(shape) - 1)))
+    ellipse = trace_ellipse(centre, sign*widths, (numpy.zeros(len(shape), int), numpy.array(shape) - 1))
     clipped = numpy.maximum(numpy.minimum(centre, numpy.array(shape) - 1), numpy.zeros(len(shape), int))
-    limits1 = [numpy.sort([corner[1], z + sign[1]]) + numpy.array([0, 1]) for x, z in ellipse]
-    limits2 = (numpy.sort([corner[1], clipped[1]]) + numpy.array([0, 1]) for z in xrange(0, shape[0] - len(limits1)))
-    return mask_lines(shape, itertools.chain(limits1, limits2), clipped[0], sign[0])
+    zs = ellipse[:, 1] + sign[1]
+    limits1 = numpy.column_stack((numpy.minimum(corner[1], zs), numpy.maximum(corner[1], zs) + 1))
+    limits2 = numpy.repeat([numpy.sort([corner[1], clipped[1]]) + numpy.array([0, 1])], max(0, shape[0] - len(limits1)), axis=0)
+    return mask_lines(shape, numpy.concatenate((limits1, limits2)), clipped[0], sign[0])
 
 def make_mask_straights(shape, width, seed, components, straights):
     """ Make a mask out of all straight edge types """
     
     mask = numpy.zeros(shape, dtype=bool)
-    for v in straights:
-        base_width = int(numpy.round(width/narrowing_factor)) if vec.inside(-v, components) else int(numpy.round(width))
-        shore = itertools.repeat(base_width) if seed is None else river_shore(shape, seed, base_width, v)
+    for v in vec.mask2vecs(straights):
+        base_width = int(numpy.round(width/narrowing_factor)) if components & vec.dir2bit(-v) else int(numpy.round(width))
+        shore = [base_width]*shape[0 if v[0] == 0 else 1] if seed is None else river_shore(shape, seed, base_width, v)
         mask = numpy.logical_or(mask, mask_edge(shape, v, shore))
         
     return mask
@@ -280,9 +381,9 @@ def make_mask_corners(shape, width, seed, components, concave, convex):
     
     mask = numpy.zeros(shape, dtype=bool)
     for corners, masker in ((concave, mask_concave_corner), (convex, mask_convex_corner)):
-        for v in corners:
-            xwidth = int(numpy.round(width/narrowing_factor)) if vec.inside(v*numpy.array([-1,  0], int), components) else int(numpy.round(width))
-            zwidth = int(numpy.round(width/narrowing_factor)) if vec.inside(v*numpy.array([ 0, -1], int), components) else int(numpy.round(width))
+        for v in vec.mask2vecs(corners):
+            xwidth = int(numpy.round(width/narrowing_factor)) if components & vec.dir2bit(v*numpy.array([-1,  0], int)) else int(numpy.round(width))
+            zwidth = int(numpy.round(width/narrowing_factor)) if components & vec.dir2bit(v*numpy.array([ 0, -1], int)) else int(numpy.round(width))
             
             if seed is not None and masker is mask_concave_corner:
                 xwidth = river_shore(shape, seed, xwidth, v*numpy.array([1, 0]))[shape[1] - 1 if v[0] > 0 else 0]
@@ -293,11 +394,21 @@ def make_mask_corners(shape, width, seed, components, concave, convex):
     return mask
 
 def make_mask(shape, edge, width, seed):
-    """ Make a mask representing a valley out of a countour edge specification """
-    
-    straights, concave, convex = get_features(edge)
-    components = vec.uniques(itertools.chain.from_iterable(vec.decompose(v) for v in itertools.chain(straights, concave, convex)))
-    return numpy.logical_or(
-        make_mask_straights(shape, width, seed, components, straights),
-        make_mask_corners(shape, width, seed, components, concave, convex)
-    )
+    """
+    Make a mask representing a valley out of a countour edge
+    specification given as a direction mask. Masks made without
+    a seed are cached and must not be modified.
+    """
+    
+    def make():
+        straights, concave, convex, components = edge_features[edge]
+        return numpy.logical_or(
+            make_mask_straights(shape, width, seed, components, straights),
+            make_mask_corners(shape, width, seed, components, concave, convex)
+        )
+    
+    # Without a seed the mask is the same wherever the edge is found
+    if seed is None:
+        return mask_cache.get((tuple(shape), edge, width, narrowing_factor, corner_radius_offset), make)
+    else:
+        return make()
@@ -13,6 +13,11 @@ contour_combine = False
 merge_types = ['river']
 merge_no_shift = False
 merge_no_merge = False
+height_cache = True
+height_cache_file_name = 'heights.dat'
+height_cache_size = contour.HeightCache.limit
+convert_version = contour.Contour.version
+convert_output = None
 shift_down = 1
 shift_immediate = False
 world_dir = None
@@ -187,6 +192,7 @@ class BaseCommand(Command):
         print "                 data collected in the trace phase"
         print "  relight        relights all chunks in the world without doing anything"
         print "                 else, note that other modes do this automatically"
+        print "  convert        rewrites the contour file using another file format"
         print 
         print "Options:"
         print "-h, --help                    displays this help"
@@ -240,7 +246,7 @@ class ShiftCommand(Command):
     name = "shift"
     
     short_opts = "d:u:irc:"
-    long_opts = ['help', 'down=', 'up=', 'immediate', 'reset', 'contour=', 'no-relight']
+    long_opts = ['help', 'down=', 'up=', 'immediate', 'reset', 'contour=', 'no-relight', 'patch-light']
     
     def usage(self):
         print "Usage: %s %s <world_dir>" % (program_name, self.name)
@@ -264,6 +270,8 @@ class ShiftCommand(Command):
         print "                              world directory, default: %s" % contour_file_name
         print "    --no-relight              don't do relighting, this is faster but leaves"
         print "                              dark areas"
+        print "    --patch-light             keep the light of shifted chunks and only relight"
+        print "                              those bordering chunks shifted differently"
         
     def parse(self, opts, args):
         global world_dir, shift_down, shift_immediate, contour_file_name, contour_reset
@@ -285,25 +293,36 @@ class ShiftCommand(Command):
             elif opt == '--no-relight':
                 various.Shifter.relight = False
                 merge.Merger.relight = False
+            elif opt == '--patch-light':
+                various.Shifter.patch_light = True
             
 @__add_command
 class RelightCommand(Command):
     name = "relight"
     
-    short_opts = ""
-    long_opts = ['help']
+    short_opts = "j:"
+    long_opts = ['help', 'jobs=']
     
     def usage(self):
         print "Usage: %s %s <world_dir>" % (program_name, self.name)
         print
         print "Relights all the chunks in the world without doing anything else."
         print "Note that some of the other commands do this automatically."
+        print 
+        print "Options:"
+        print "-j  --jobs=<val>              number of processes used to relight chunks in"
+        print "                              parallel, default: %d" % various.Relighter.jobs
         
     def parse(self, opts, args):
         global world_dir
         
         _do_help(self, opts)
         world_dir = _get_world_dir(args)
+        
+        for opt, arg in opts:
+            if opt in ('-j', '--jobs'):
+                jobs = _get_int(arg, 'number of jobs')
+                various.Relighter.jobs = jobs if jobs > 1 else 1
             
 @__add_command
 class TraceCommand(Command):
@@ -409,7 +428,7 @@ class TraceCommand(Command):
 class MergeCommand(Command):
     name = "merge"
     
-    short_opts = "s:f:c:d:r:v:"
+    short_opts = "s:f:c:d:r:v:j:"
     long_opts = ['help', 'smooth-factor=', 'factor-river=', 'factor-even=',
                  'filter=', 'filter-river=', 'filter-even=', 'river-width=',
                  'valley-width=', 'river-height=', 'valley-height=',
@@ -417,7 +436,9 @@ class MergeCommand(Command):
                  'river-centre-bend=', 'river-width-bend=',
                  'sea-level=', 'narrow-factor=',
                  'no-shift', 'no-merge', 'cover-depth=',
-                 'contour=', 'no-relight']
+                 'height-cache=', 'height-cache-size=', 'no-height-cache',
+                 'jobs=', 'chunk-budget=', 'relight-band',
+                 'contour=', 'no-relight', 'patch-light']
     
     def usage(self):
         print "Usage: %s %s <world_dir>" % (program_name, self.name)
@@ -458,15 +479,32 @@ class MergeCommand(Command):
         print "    --no-shift                don't perform shifting operations"
         print "    --no-merge                don't perform merging operations"
         print
+        print "    --height-cache=<file>     file in the world directory caching chunk height"
+        print "                              maps between runs, default: %s" % height_cache_file_name
+        print "    --height-cache-size=<val> maximum number of cached chunk height maps,"
+        print "                              default: %d" % height_cache_size
+        print "    --no-height-cache         don't use the height map cache"
+        print
+        print "-j, --jobs=<val>              number of processes used to reshape chunks in"
+        print "                              parallel, default: %d" % merge.Merger.jobs
+        print "    --chunk-budget=<val>      save and let go of reshaped chunks a region at"
+        print "                              a time once this many are held in memory, the"
+        print "                              limit applies per stage, default: no limit"
+        print "    --relight-band            only relight reshaped chunks and those around"
+        print "                              them, from the lowest height changed up"
+        print
         print "Common options:"
         print "-c, --contour=<file_name>     file that records the contour data in the"
         print "                              world directory, default: %s" % contour_file_name
         print "    --no-relight              don't do relighting, this is faster but leaves"
         print "                              dark areas"
+        print "    --patch-light             keep the light of shifted chunks and only relight"
+        print "                              those bordering chunks shifted differently"
         
     def parse(self, opts, args):
         global world_dir, contour_file_name
         global merge_no_shift, merge_no_merge
+        global height_cache, height_cache_file_name, height_cache_size
         
         _do_help(self, opts)
         world_dir = _get_world_dir(args)
@@ -526,9 +564,68 @@ class MergeCommand(Command):
                 merge_no_shift = True
             elif opt == '--no-merge':
                 merge_no_merge = True
+            elif opt == '--height-cache':
+                height_cache_file_name = arg
+            elif opt == '--height-cache-size':
+                height_cache_size = _get_int(arg, 'height cache size')
+                if height_cache_size < 0:
+                    height_cache_size = 0
+            elif opt == '--no-height-cache':
+                height_cache = False
+            elif opt in ('-j', '--jobs'):
+                jobs = _get_int(arg, 'number of jobs')
+                merge.Merger.jobs = jobs if jobs > 1 else 1
+            elif opt == '--chunk-budget':
+                budget = _get_int(arg, 'chunk budget')
+                merge.Merger.chunk_budget = budget if budget > 1 else 1
+            elif opt == '--relight-band':
+                merge.Merger.relight_band = True
             elif opt in ('-c', '--contour'):
                 contour_file_name = arg
             elif opt == '--no-relight':
                 various.Shifter.relight = False
                 merge.Merger.relight = False
+            elif opt == '--patch-light':
+                various.Shifter.patch_light = True
+
+@__add_command
+class ConvertCommand(Command):
+    name = "convert"
+    
+    short_opts = "v:o:c:"
+    long_opts = ['help', 'version=', 'output=', 'contour=']
+    
+    def usage(self):
+        print "Usage: %s %s <world_dir>" % (program_name, self.name)
+        print
+        print "Rewrites the contour file using the given file format version. Version 2"
+        print "is a text format that may be edited by hand while version 3 is a compact"
+        print "binary format that is much faster to read and write. Any version may be"
+        print "read by the other commands."
+        print
+        print "Options:"
+        print "-v, --version=<val>           contour file format version to convert to,"
+        print "                              one of: 2, 3 (default: %d)" % convert_version
+        print "-o, --output=<file_name>      file in the world directory to write the"
+        print "                              converted contour to, default: same file"
+        print
+        print "Common options:"
+        print "-c, --contour=<file_name>     file that records the contour data in the"
+        print "                              world directory, default: %s" % contour_file_name
+        
+    def parse(self, opts, args):
+        global world_dir, contour_file_name, convert_version, convert_output
+        
+        _do_help(self, opts)
+        world_dir = _get_world_dir(args)
+        
+        for opt, arg in opts:
+            if opt in ('-v', '--version'):
+                convert_version = _get_int(arg, 'contour file version')
+                if convert_version not in (2, 3):
+                    error('contour file version must be one of: 2, 3')
+            elif opt in ('-o', '--output'):
+                convert_output = arg
+            elif opt in ('-c', '--contour'):
+                contour_file_name = arg
 
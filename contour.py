@@ -1,4 +1,4 @@
-import itertools, collections
+import os.path, glob, mmap, re, itertools, collections, struct, zlib
 import numpy
 from pymclevel import mclevel
 import ancillary, filter, carve, vec
@@ -6,6 +6,52 @@ import ancillary, filter, carve, vec
 class ContourLoadError(Exception):
     pass
 
+def region_chunks(world_dir):
+    """
+    Finds which chunks are present in a world by reading only the
+    chunk location tables at the start of its region files, the
+    chunks themselves are never loaded. Anvil region files are used
+    in preference to the older McRegion files, as the game does.
+    Returns an array of chunk co-ordinates, or None if the world
+    has no region files.
+    """
+    
+    if os.path.isfile(world_dir):
+        world_dir = os.path.dirname(world_dir)
+    region_dir = os.path.join(world_dir, 'region')
+    
+    for ext in ('mca', 'mcr'):
+        files = glob.glob(os.path.join(region_dir, 'r.*.*.%s' % ext))
+        if files:
+            break
+    else:
+        return None
+    
+    size = 32
+    name_re = re.compile(r'^r\.(-?\d+)\.(-?\d+)\.%s$' % ext)
+    local = numpy.indices((size, size))[::-1].reshape(2, -1).T
+    
+    chunks = []
+    for file_name in files:
+        match = name_re.match(os.path.basename(file_name))
+        if match is None:
+            continue
+        
+        # Any chunk with a location entry is present
+        with open(file_name, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < size*size*4:
+                continue
+            m = mmap.mmap(f.fileno(), size*size*4, access=mmap.ACCESS_READ)
+            try:
+                present = numpy.frombuffer(m, '>u4', size*size) != 0
+            finally:
+                m.close()
+        
+        region = numpy.array([int(match.group(1)), int(match.group(2))])
+        chunks.append(local[present] + region*size)
+        
+    return numpy.concatenate(chunks) if chunks else numpy.zeros((0, 2), int)
+
 MethodsFields = collections.namedtuple('MethodsFields', ('bit', 'symbol'))
 EdgeData = ancillary.record('EdgeData', ('method', 'direction'))
 
@@ -13,7 +59,7 @@ class Contour(object):
     """
     Class for finding and recording the contour of the world. The contour
     is stored as a dictionary of tuple co-ordinates and edge direction
-    vectors.
+    masks, with a bit for each of the vec.directions surrounding a chunk.
     """
     
     zenc = {-1: 'N', 0: '', 1: 'S'}
@@ -38,6 +84,16 @@ class Contour(object):
         __metaclass__ = ancillary.Enum
         __elements__ = ('add', 'replace', 'transition')
     
+    region_size = 32            # Width of the square of chunks traced at a time
+    
+    # The binary contour file format has a header with the record count and
+    # size followed by one fixed size record for each chunk
+    version = 3                 # Format version used when writing
+    header = struct.Struct('<II')
+    record = numpy.dtype([('coord', '<i4', 2), ('shift', '<i4'), ('method', '<u2'), ('direction', 'u1'), ('flags', 'u1')])
+    has_shift = 1
+    has_edge = 2
+    
     def __init__(self):
         self.shift = {}         # Each coordinate maps to an integer shift distance
         self.edges = {}         # Each coordinate points to an EdgeData instance
@@ -49,19 +105,20 @@ class Contour(object):
         # not considered
         return not (self.shift or self.edges)
     
-    def height_map(self, level, block_roles):
+    def height_map(self, level, block_roles, cache=None):
         """
         Returns a height map object that integrates with and
-        modifies the height map data.
+        modifies the height map data. An optional persistent
+        height cache may be given to avoid recalculation.
         """
         
-        return HeightMap(self.heights, self.edges, level, block_roles)
+        return HeightMap(self.heights, self.edges, level, block_roles, cache)
     
     @staticmethod
     def __merge_edge(a, b):
         """Merges two edges into a new value with elements of both"""
         
-        return EdgeData(a.method & b.method, a.direction + b.direction)
+        return EdgeData(a.method & b.method, a.direction | b.direction)
         
     def __surrounding(self, coord):
         """Generate coordinates of all surrounding chunks"""
@@ -71,27 +128,55 @@ class Contour(object):
                 if z != 0 or x != 0:
                     yield (coord[0] + x, coord[1] + z), (x, z)
         
-    def __trace_edge(self, edges, chunk, all_chunks):
-        """
-        Checks surrounding chunks and records a set of
-        vectors for the direction of contour faces.
-        """
-        
-        for curr, (x, z) in self.__surrounding(chunk):
-            if curr not in all_chunks:
-                edges.setdefault(chunk, set()).add((x, z))      # Edge for our existing chunk
-                edges.setdefault(curr,  set()).add((-x, -z))    # Counter edge for the missing chunk
-                
-    def __trace(self, level):
+    def __trace(self, chunks):
         """
         Simply find edges at the interface between existing
         and missing chunks.
+        
+        The chunks are laid out on an occupancy grid one region
+        at a time. A chunk is on the contour in the direction of
+        any neighbour with differing occupancy, so all the edges
+        are found by comparing the grid with shifted copies.
+        The chunks are given as an array of co-ordinates.
         """
         
+        size = self.region_size
+        
+        # Lay out the chunks on the grid of their region, region co-ordinates
+        # are packed into 64-bit keys even where the default integer is 32-bit
+        offset = 1 << 30
+        regions = (chunks // size).astype(numpy.int64) + offset
+        keys, index = numpy.unique((regions[:, 0] << 32) | regions[:, 1], return_inverse=True)
+        grids = numpy.zeros((len(keys), size, size), bool)
+        grids[index, chunks[:, 0] % size, chunks[:, 1] % size] = True
+        occupied = dict(((int(k >> 32) - offset, int(k & 0xffffffff) - offset), i) for i, k in enumerate(keys))
+        
+        # Missing chunks bordering a region can be on the contour too
+        traced = set((rx + x, rz + z) for rx, rz in occupied for x in xrange(-1, 2) for z in xrange(-1, 2))
+        
+        # Source and destination slices for the parts of the surrounding regions that border a region
+        border = {-1: (slice(size - 1, size), slice(0, 1)),
+                   0: (slice(0, size), slice(1, size + 1)),
+                   1: (slice(0, 1), slice(size + 1, size + 2))}
+        
         edges = {}
-        all_chunks = set(level.allChunks)
-        for chunk in all_chunks:
-            self.__trace_edge(edges, chunk, all_chunks)
+        for rx, rz in traced:
+            occ = numpy.zeros((size + 2, size + 2), bool)
+            for z in xrange(-1, 2):
+                for x in xrange(-1, 2):
+                    i = occupied.get((rx + x, rz + z))
+                    if i is not None:
+                        (xsrc, xdst), (zsrc, zdst) = border[x], border[z]
+                        occ[xdst, zdst] = grids[i, xsrc, zsrc]
+            
+            # Find the directions of all the faces
+            centre = occ[1:size + 1, 1:size + 1]
+            mask = numpy.zeros((size, size), numpy.uint8)
+            for bit, (x, z) in enumerate(vec.directions):
+                mask |= (centre != occ[1 + x:size + 1 + x, 1 + z:size + 1 + z]).astype(numpy.uint8) << bit
+            
+            for x, z in itertools.izip(*mask.nonzero()):
+                edges[(rx*size + int(x), rz*size + int(z))] = int(mask[x, z])
             
         return edges
     
@@ -127,7 +212,7 @@ class Contour(object):
         # Return only selected edges
         return dict((coord, trace[coord]) for coord in retain)
         
-    def __select_direct(self, op, level):
+    def __select_direct(self, op, chunks):
         """
         Creates new edge out of chunks in the old one based
         on the world map.
@@ -142,7 +227,7 @@ class Contour(object):
             
         # Find which chunks to retain in the selection
         else:
-            all_chunks = set(level.allChunks)
+            all_chunks = set(itertools.imap(tuple, chunks.tolist()))
             if op == self.SelectOperation.missing:
                 return dict((coord, edge.direction) for coord, edge
                                                     in self.edges.iteritems()
@@ -209,12 +294,10 @@ class Contour(object):
     def __find_join_edge(self, trace, edges):
         # Helpers
         def features(direction):
-            """ Get a full set of edge features """
+            """ Get a full set of edge features as a direction mask """
             
-            features = set()
-            for component in carve.get_features(vec.tuples2vecs(direction)):
-                features.update(vec.vecs2tuples(component))
-            return features
+            features = carve.edge_features[direction]
+            return features.straights | features.concave | features.convex
         
         # Finding the joining chunks
         join = set()
@@ -235,6 +318,18 @@ class Contour(object):
                     
         return join
             
+    @staticmethod
+    def __world_chunks(world_dir):
+        """
+        Gets an array of the co-ordinates of all chunks in the world,
+        straight from the region files if possible.
+        """
+        
+        chunks = region_chunks(world_dir)
+        if chunks is None:
+            chunks = numpy.array(list(mclevel.fromFile(world_dir).allChunks), int).reshape(-1, 2)
+        return chunks
+    
     def trace_world(self, world_dir, methods):
         """
         Find the contour of the existing world defining the
@@ -242,7 +337,7 @@ class Contour(object):
         """
         
         method_bits = reduce(lambda a, x: a | self.methods[x].bit, methods, 0)
-        trace = self.__trace(mclevel.fromFile(world_dir))
+        trace = self.__trace(self.__world_chunks(world_dir))
         self.edges = dict((k, EdgeData(method_bits, v)) for k, v in trace.iteritems())
             
     def trace_combine(self, world_dir, combine, methods, select, join):
@@ -251,15 +346,15 @@ class Contour(object):
         chunks, then merge appropriately with existing data.
         """
         
-        level = mclevel.fromFile(world_dir)
+        chunks = self.__world_chunks(world_dir)
         
         # NOTE: The 'trace' only records edge contours while the 'edges'
         #       also specify the merge method for the edge.
         if select in (self.SelectOperation.missing,):
-            trace = self.__select_direct(select, level)
+            trace = self.__select_direct(select, chunks)
             edges = self.__join(join, methods, trace, self.__find_join_direct)
         else:
-            trace = self.__trace(level)
+            trace = self.__trace(chunks)
             trace = self.__select_edge(select, trace)
             edges = self.__join(join, methods, trace, self.__find_join_edge)
         
@@ -268,46 +363,69 @@ class Contour(object):
         else:
             self.edges = edges
     
-    def write(self, file_name):
-        """ Write to file using """
-    
-        with open(file_name, 'w') as f:
-            # Write header
-            f.write('VERSION 2\n')
+    def write(self, file_name, version=None):
+        """ Write to file using the given format version, the latest by default. """
+        
+        if version is None:
+            version = self.version
             
-            # Collect all data
-            blocks = set(self.edges.keys()) | set(self.shift.keys())
-            for coords in blocks:
-                # Assemble the block shifting data
-                try:
-                    shift = self.shift[coords]
-                    shift_data = '% 5d' % shift
-                except LookupError:
-                    shift_data = '%5s' % '-'
-                    
-                # Assemble the edge merging data
-                try:
-                    edge = self.edges[coords]
-                    method_data = ''.join(m.symbol for m in self.methods.itervalues() if m.bit & edge.method)
-                    direction = ' '.join((''.join((self.zenc[v1], self.xenc[v0])) for v0, v1 in edge.direction))
-                    edge_data = ('%%-%ds %%s' % len(self.methods)) % (method_data, direction)
-                except LookupError:
-                    edge_data = '-'
+        try:
+            writer = getattr(self, '_Contour__write_v%d' % version)
+        except AttributeError:
+            raise ValueError("unknown version format '%s'" % version)
+        
+        with open(file_name, 'wb') as f:
+            # Write header
+            f.write('VERSION %d\n' % version)
+            writer(f)
+    
+    def __write_v2(self, f):
+        # Collect all data
+        blocks = set(self.edges.keys()) | set(self.shift.keys())
+        for coords in blocks:
+            # Assemble the block shifting data
+            try:
+                shift = self.shift[coords]
+                shift_data = '% 5d' % shift
+            except LookupError:
+                shift_data = '%5s' % '-'
                 
-                # Write complete set of data to output
-                f.write('%6d %6d %s %s\n' % (coords[0], coords[1], shift_data, edge_data))
+            # Assemble the edge merging data
+            try:
+                edge = self.edges[coords]
+                method_data = ''.join(m.symbol for m in self.methods.itervalues() if m.bit & edge.method)
+                direction = ' '.join((''.join((self.zenc[v1], self.xenc[v0])) for v0, v1 in vec.mask2dirs(edge.direction)))
+                edge_data = ('%%-%ds %%s' % len(self.methods)) % (method_data, direction)
+            except LookupError:
+                edge_data = '-'
+            
+            # Write complete set of data to output
+            f.write('%6d %6d %s %s\n' % (coords[0], coords[1], shift_data, edge_data))
+    
+    def __write_v3(self, f):
+        blocks = sorted(set(self.edges.keys()) | set(self.shift.keys()))
+        records = numpy.zeros(len(blocks), self.record)
+        if blocks:
+            records['coord'] = blocks
+            records['shift'] = [self.shift.get(coords, 0) for coords in blocks]
+            records['method'] = [self.edges[coords].method if coords in self.edges else 0 for coords in blocks]
+            records['direction'] = [self.edges[coords].direction if coords in self.edges else 0 for coords in blocks]
+            records['flags'] = [(self.has_shift if coords in self.shift else 0) | (self.has_edge if coords in self.edges else 0)
+                                for coords in blocks]
+        
+        f.write(self.header.pack(len(records), self.record.itemsize))
+        f.write(records.tostring())
     
     def read(self, file_name, update=False):
         """ Read from file. If update, don't clear existing data. """
         
-        with open(file_name, 'r') as f:
+        with open(file_name, 'rb') as f:
             if not update:
                 self.shift = {}
                 self.edges = {}
                 
-            try:
-                line = f.next()
-            except StopIteration:
+            line = f.readline()
+            if not line:
                 return
             
             if line.startswith('VERSION'):
@@ -318,14 +436,17 @@ class Contour(object):
                 lines = itertools.chain([line], f)
                 
             try:
-                getattr(self, '_Contour__read_v%d' % version)(lines)
+                reader = getattr(self, '_Contour__read_v%d' % version)
             except AttributeError:
-                raise ContourLoadError("unknown version format '%s'")
+                raise ContourLoadError("unknown version format '%s'" % version)
+            
+            # Binary formats are read straight from the file
+            reader(f if version >= 3 else lines)
                 
     def __read_v1(self, lines):
         for line in lines:
             arr = line.strip().split(None, 2)
-            direction = set(tuple(sum(-self.sdec[c] for c in s)) for s in arr[2].split())
+            direction = vec.dirs2mask(tuple(sum(-self.sdec[c] for c in s)) for s in arr[2].split())
             self.edges[(int(arr[0]), int(arr[1]))] = EdgeData(self.methods['river'].bit, direction)
             
     def __read_v2(self, lines):
@@ -338,31 +459,98 @@ class Contour(object):
                 
             if arr[3] != '-':
                 method = sum(sum(m.bit for m in self.methods.itervalues() if m.symbol == s) for s in arr[3])
-                direction = set(tuple(sum(self.sdec[c] for c in s)) for s in arr[4].split())
+                direction = vec.dirs2mask(tuple(sum(self.sdec[c] for c in s)) for s in arr[4].split())
                 self.edges[coords] = EdgeData(method, direction)
+    
+    def __read_v3(self, f):
+        offset = f.tell()
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if len(m) < offset + self.header.size:
+                raise ContourLoadError('contour file is truncated')
+            count, size = self.header.unpack_from(m, offset)
+            if size != self.record.itemsize:
+                raise ContourLoadError('contour file has unknown record size %d' % size)
+            if len(m) < offset + self.header.size + count*size:
+                raise ContourLoadError('contour file is truncated')
+            
+            records = numpy.frombuffer(m, self.record, count, offset + self.header.size).copy()
+        finally:
+            m.close()
+        
+        fields = (records[name].tolist() for name in ('coord', 'shift', 'method', 'direction', 'flags'))
+        for (x, z), shift, method, direction, flags in itertools.izip(*fields):
+            if flags & self.has_shift:
+                self.shift[(x, z)] = shift
+            if flags & self.has_edge:
+                self.edges[(x, z)] = EdgeData(method, direction)
 
 class HeightMap(object):
     """
     This object is used to provide height map arrays at requested
     coordinates. Requested height maps are cached and the ones that
-    are no longer required for merging may be explicitly pruned.
+    are no longer referenced by pending contour edges are released.
     """
     
-    def __init__(self, heights, edges, level, block_roles):
+    prefetch_batch = 256        # Number of chunks stacked together when prefetching
+    
+    def __init__(self, heights, edges, level, block_roles, cache=None):
         self.__heights = heights
         self.__edges = edges
         self.__level = level
         self.__block_roles = block_roles
         self.__deferred = set()
+        self.__references = {}
+        self.__cache = cache
+        self.hits = 0
+        self.misses = 0
+        
+        if self.__cache is not None:
+            self.__cache.check(block_roles.tables.terrain)
         
     def __getitem__(self, key):
         try:
-            return self.__heights[key]
+            height = self.__heights[key]
         except KeyError:
-            chunk = self.__level.getChunk(*key)
-            height = self.find_heights(chunk.Blocks, self.__block_roles)
-            self.__heights[key] = height
-            return height
+            self.prefetch([key])
+            return self.__heights[key]
+        
+        self.hits += 1
+        return height
+    
+    def prefetch(self, coords):
+        """
+        Calculates height maps for all the given chunk coordinates
+        that are not already cached. The chunks are stacked together
+        so the heights are found in a few large vectorised passes
+        rather than one chunk at a time.
+        """
+        
+        coords = set(coords)
+        missing = sorted(coord for coord in coords if coord not in self.__heights)
+        self.hits += len(coords) - len(missing)
+        self.misses += len(missing)
+        for start in xrange(0, len(missing), self.prefetch_batch):
+            batch = [(coord, self.__level.getChunk(*coord).Blocks) for coord in missing[start:start + self.prefetch_batch]]
+            
+            # Take what we can from the persistent cache
+            if self.__cache is not None:
+                digests = {}
+                for coord, blocks in batch:
+                    digests[coord] = self.__cache.digest(blocks)
+                    height = self.__cache.get(coord, digests[coord])
+                    if height is not None:
+                        self.__heights[coord] = height
+                batch = [(coord, blocks) for coord, blocks in batch if coord not in self.__heights]
+                if not batch:
+                    continue
+            
+            # Calculate the rest in one go
+            heights = self.find_heights(numpy.array([blocks for _, blocks in batch]), self.__block_roles)
+            for (coord, _), height in itertools.izip(batch, heights):
+                self.__heights[coord] = height
+                if self.__cache is not None:
+                    self.__cache.put(coord, digests[coord], height)
     
     @property
     def invalidations(self):
@@ -404,45 +592,146 @@ class HeightMap(object):
         
         self.__heights.clear()
     
-    def prune(self, radius):
+    def reference(self, coords):
         """
-        Removes height maps no longer needing caching given the
-        remaining set of contour edges. This prunes the heights
-        dictionary used to initialise this object.
-        
-        The radius specifies how many blocks around any chunk
-        would be affected by its removal.
+        Records that a pending contour edge will need the height maps
+        at the given coordinates. Each coordinate is counted once for
+        every time it is referenced.
         """
         
-        # This is not terribly efficient but we'll let the
-        # profiler decide later
+        for coord in coords:
+            self.__references[coord] = self.__references.get(coord, 0) + 1
+    
+    def release(self, coords):
+        """
+        Records that a contour edge no longer needs the height maps at
+        the given coordinates. Height maps no longer needed by any
+        pending edge are removed straight away.
+        """
         
-        range = (-radius, radius+1)
+        for coord in coords:
+            count = self.__references[coord] - 1
+            if count > 0:
+                self.__references[coord] = count
+            else:
+                del self.__references[coord]
+                self.invalidate(coord)
+    
+    @staticmethod
+    def find_heights(block_ids, block_roles):
+        """ Create heigh-map based on highest solid object """
         
-        def still_required(coords):
-            for z in xrange(*range):
-                for x in xrange(*range):
-                    if (coords[0] + x, coords[1] + z) in self.__edges:
-                        return False
-            return True
+        # Search each column from the top for the first terrain block,
+        # columns without any terrain are given a height of -1
+        solid = block_roles.tables.terrain[block_ids]
+        my = block_ids.shape[-1]
+        top = my - 1 - numpy.argmax(solid[..., ::-1], axis=-1)
+        return numpy.where(solid.any(axis=-1), top, -1).astype(int)
+
+class HeightCache(object):
+    """
+    Persistent store for chunk height maps so they need not be
+    recalculated on every run. Each height map is recorded along
+    with a digest of the chunk block data it was found from and is
+    only used while the chunk remains unchanged. Once the size
+    limit is reached the least recently used entries are dropped.
+    """
+    
+    magic = 'MCMHGT'
+    version = 1
+    limit = 65536
+    
+    header = struct.Struct('<6sHIII')
+    record = numpy.dtype([('coord', '<i4', 2), ('digest', '<u4'), ('height', '<i2', (16, 16))])
+    
+    def __init__(self, limit=None):
+        if limit is not None:
+            self.limit = limit
         
-        for coord in self.__heights.keys():
-            if not still_required(coord):
-                del self.__heights[coord]
+        self.__entries = collections.OrderedDict()  # Coordinates map to (digest, height) in order of use
+        self.__terrain = None
+        self.hits = 0
+        self.misses = 0
         
+    def __len__(self):
+        return len(self.__entries)
+    
     @staticmethod
-    def find_heights(block_ids, block_roles):
-        """ Create heigh-map based on highest solid object """
+    def digest(block_ids):
+        """ Digest identifying the content of a chunk block array """
         
-        mx, mz, my = block_ids.shape
-        height = numpy.empty((mx, mz), int)
-        for x in xrange(0, mx):
-            for z in xrange(0, mz):
-                for y in xrange(my - 1, -1, -1):
-                    if block_ids[x, z, y] in block_roles.terrain:
-                        height[x, z] = y
-                        break
-                else:
-                    height[x, z] = -1
+        return zlib.crc32(numpy.ascontiguousarray(block_ids).data) & 0xffffffff
+    
+    def check(self, terrain_table):
+        """
+        Discards all entries if they were not calculated using the
+        given terrain lookup table.
+        """
         
-        return height
+        terrain = zlib.crc32(terrain_table.tostring()) & 0xffffffff
+        if terrain != self.__terrain:
+            self.__entries.clear()
+            self.__terrain = terrain
+    
+    def get(self, coord, digest):
+        """
+        Returns the height map for the given chunk or None if no
+        height map matching the chunk digest is stored.
+        """
+        
+        try:
+            entry = self.__entries.pop(coord)
+        except KeyError:
+            self.misses += 1
+            return None
+        
+        if entry[0] != digest:
+            self.misses += 1
+            return None
+        
+        self.__entries[coord] = entry
+        self.hits += 1
+        return entry[1]
+    
+    def put(self, coord, digest, height):
+        """ Records the height map found for the given chunk """
+        
+        if height.shape != self.record['height'].shape:
+            return
+        
+        self.__entries.pop(coord, None)
+        self.__entries[coord] = (digest, height)
+        while len(self.__entries) > self.limit:
+            self.__entries.popitem(last=False)
+    
+    def read(self, file_name):
+        """ Read from file, replaces all existing entries. """
+        
+        with open(file_name, 'rb') as f:
+            data = f.read()
+        
+        try:
+            magic, version, terrain, count, size = self.header.unpack_from(data)
+        except struct.error:
+            raise ContourLoadError("height cache file is truncated")
+        if magic != self.magic or version != self.version or size != self.record.itemsize:
+            raise ContourLoadError("unknown height cache format")
+        if len(data) < self.header.size + count*size:
+            raise ContourLoadError("height cache file is truncated")
+        
+        records = numpy.frombuffer(data, self.record, count, self.header.size)
+        self.__terrain = terrain
+        self.__entries.clear()
+        for record in records[max(0, count - self.limit):]:
+            self.__entries[tuple(int(x) for x in record['coord'])] = (int(record['digest']), record['height'].astype(int))
+    
+    def write(self, file_name):
+        """ Write all entries to file, least recently used first. """
+        
+        records = numpy.empty(len(self.__entries), self.record)
+        for n, (coord, (digest, height)) in enumerate(self.__entries.iteritems()):
+            records[n] = (coord, digest, height)
+        
+        with open(file_name, 'wb') as f:
+            f.write(self.header.pack(self.magic, self.version, self.__terrain or 0, len(records), self.record.itemsize))
+            f.write(records.tostring())
@@ -13,43 +13,80 @@ filters = {
     'gauss':    'gsmooth',
 }
 
+_frequencies = {}   # Radial frequency grid for each spectrum shape
+_cut_masks = {}     # Retained frequencies for each spectrum shape and cut off
+_drop_weights = {}  # Frequency weights for each spectrum shape and drop off function
+
+def frequencies(shape):
+    """
+    Radial frequency of every element of a 2D DFT spectral
+    result with the given shape. The grid is shared and must
+    not be modified.
+    """
+    
+    try:
+        return _frequencies[shape]
+    except KeyError:
+        pass
+    
+    # Distance to the nearest zero frequency corner
+    mx, my = shape
+    x = numpy.arange(0, mx)[:, numpy.newaxis]
+    y = numpy.arange(0, my)
+    f = numpy.sqrt(numpy.minimum(x**2, (x - mx)**2) + numpy.minimum(y**2, (y - my)**2))
+    
+    _frequencies[shape] = f
+    return f
+
+def cut_mask(shape, cut):
+    """
+    Frequencies of a 2D DFT spectral result with the given
+    shape that are retained by the cut off frequency.
+    """
+    
+    try:
+        return _cut_masks[(shape, cut)]
+    except KeyError:
+        keep = _cut_masks[(shape, cut)] = ~(frequencies(shape) > cut)
+        return keep
+
+def drop_weights(shape, drop):
+    """
+    Weights of the frequencies of a 2D DFT spectral result
+    with the given shape according to the drop off function.
+    """
+    
+    try:
+        return _drop_weights[(shape, drop)]
+    except KeyError:
+        weights = numpy.array([drop(f) for f in frequencies(shape).flat]).reshape(shape)
+        _drop_weights[(shape, drop)] = weights
+        return weights
+
+def half(grid):
+    """
+    Part of a full spectrum grid matching the half spectrum
+    of a real input DFT. The frequencies are symmetric so
+    nothing is lost.
+    """
+    
+    return grid[:, :grid.shape[1]//2 + 1]
+
 def ftrim(a, cut):
     """
     Takes a 2D DFT spectral result and removes frequencies
     above the cut off frequency.
     """
     
-    b = a.copy()
-    
-    mx, my = b.shape
-    for x in xrange(0, mx):
-        for y in xrange(0, my):
-            f = numpy.sqrt(min(pow(x, 2) + pow(y, 2),
-                               pow(x - mx, 2) + pow(y, 2),
-                               pow(x, 2) + pow(y - my, 2),
-                               pow(x - mx, 2) + pow(y - my, 2)))
-            b[x, y] = 0 if f > cut else a[x, y]
-    
-    return b
+    return numpy.where(cut_mask(a.shape, cut), a, 0)
 
 def fftrim(a, drop):
     """
     Takes a 2D DFT spectral result and removes frequencies
     according to the normalised drop off function.
     """
-
-    b = a.copy()
     
-    mx, my = b.shape
-    for x in xrange(0, mx):
-        for y in xrange(0, my):
-            f = numpy.sqrt(min(pow(x, 2) + pow(y, 2),
-                               pow(x - mx, 2) + pow(y, 2),
-                               pow(x, 2) + pow(y - my, 2),
-                               pow(x - mx, 2) + pow(y - my, 2)))
-            b[x, y] = a[x, y]*drop(f)
-    
-    return b
+    return a*drop_weights(a.shape, drop)
 
 def pad(a, radius):
     """
@@ -58,55 +95,45 @@ def pad(a, radius):
     of the original array in all directions.
     """
     
-    def samp(c, cm):
-        """ Take a sample from the edge of the input """
-        
-        n = c - cm*radius
-        if n < 0:
-            return 0
-        elif n >= cm:
-            return cm - 1
-        else:
-            return n
-        
     mx, my = a.shape
-    factor = radius*2+1
-    
-    b = numpy.empty((mx*factor, my*factor), a.dtype)
     
-    for x in xrange(0, mx*factor):
-        for y in xrange(0, my*factor):
-            b[x, y] = a[samp(x, mx)][samp(y, my)]
-            
-    return b
+    return numpy.pad(a, ((mx*radius, mx*radius), (my*radius, my*radius)), 'edge')
 
 def crop(a, radius=1):
     """
     Crop a 2D array removing an radius number of equally
     sized arrays from each edge only leaving the centre.
+    Any leading dimensions hold a stack of arrays which are
+    all cropped. Returns a view of the original array.
     """
     
-    my, mx = a.shape
+    mx, my = a.shape[-2:]
     mx = mx / (radius*2+1)
     my = my / (radius*2+1)
     
-    b = numpy.empty((mx, my), a.dtype)
-    
-    for n, x in enumerate(xrange(mx*radius, mx*(radius+1))):
-        b[n] = a[x][my*radius:my*(radius+1)]
-        
-    return b
+    return a[..., mx*radius:mx*(radius+1), my*radius:my*(radius+1)]
 
 def smooth(a, cut, padder=pad, padding=1):
     """ Smooth by cutting out high frequencies """
     
+    return smooth_padded(padder(a, padding)[numpy.newaxis], cut, padding)[0]
+
+def smooth_padded(b, cut, padding=1):
+    """
+    Smooth a stack of already padded 2D arrays in one go by
+    cutting out high frequencies.
+    """
+    
     cut *= 1 + padding*2
-    return crop(numpy.real(numpy.fft.ifft2(ftrim(numpy.fft.fft2(padder(a, padding)), cut))), padding)
+    shape = b.shape[-2:]
+    smoothed = numpy.fft.irfft2(numpy.where(half(cut_mask(shape, cut)), numpy.fft.rfft2(b), 0), shape)
+    return crop(smoothed, padding)
 
 def fsmooth(a, drop, padder=pad, padding=1):
     """ Smooth by cutting out high frequencies, drop function defines gradual drop-off """
     
-    return crop(numpy.real(numpy.fft.ifft2(fftrim(numpy.fft.fft2(padder(a, padding)), drop))), padding)
+    b = padder(a, padding)
+    return crop(numpy.fft.irfft2(numpy.fft.rfft2(b)*half(drop_weights(b.shape, drop)), b.shape), padding)
 
 def gsmooth(a, sigma, padder=pad, padding=1):
     """ Smooth with gaussian filter """
@@ -0,0 +1,160 @@
+""" Spreads sky and block light through parts of the map """
+
+import itertools, collections
+import numpy
+
+max_light = 15
+tile_size = 8       # Width of the tiles of chunks relit together
+
+def light_tables(materials):
+    """ Light absorption and emission lookup tables indexed by block ID """
+    
+    return (numpy.array(materials.lightAbsorption, dtype=numpy.int16),
+            numpy.array(materials.lightEmission, dtype=numpy.int16))
+
+def sky_light(absorption):
+    """
+    Light falling straight down each column from the open sky. The
+    sky is seen down to the top block absorbing any light, from
+    there on every block takes away at least one level of light.
+    """
+    
+    covered = numpy.logical_or.accumulate((absorption > 0)[..., ::-1], axis=-1)[..., ::-1]
+    dimming = numpy.where(covered, numpy.clip(absorption, 1, max_light), 0)
+    sky = max_light - numpy.cumsum(dimming[..., ::-1], axis=-1)[..., ::-1]
+    return numpy.clip(sky, 0, max_light)
+
+def spread(light, dimming):
+    """
+    Spreads light through a volume until it settles, each block
+    takes the brightest light of its six neighbours less its own
+    dimming wherever that is brighter. The light is spread in place,
+    blocks dimming by more than the maximum light never change.
+    """
+    
+    brightest = numpy.empty_like(light)
+    while True:
+        brightest.fill(0)
+        for axis in xrange(light.ndim):
+            lower = [slice(None)]*light.ndim
+            upper = list(lower)
+            lower[axis] = slice(None, -1)
+            upper[axis] = slice(1, None)
+            lower = tuple(lower); upper = tuple(upper)
+            numpy.maximum(brightest[lower], light[upper], brightest[lower])
+            numpy.maximum(brightest[upper], light[lower], brightest[upper])
+        brightest -= dimming
+        
+        if not (brightest > light).any():
+            return light
+        numpy.maximum(light, brightest, light)
+
+def light_tile(level, coords, lows, tables):
+    """
+    Finds the light of the listed chunks from their lowest relit
+    layer up, as given by the 'lows' mapping. No light travels
+    further than a chunk, so light is spread through a volume that
+    takes in one chunk all around them. Chunks in this volume that
+    are also relit start out lit only by the sky and the blocks
+    themselves, any other chunks or layers keep the light they have.
+    Returns the sky and block light of each of the listed chunks.
+    """
+    
+    absorption, emission = tables
+    height = level.Height
+    sky = getattr(level, 'dimNo', 0) not in (-1, 1)
+    
+    x0 = min(x for x, _ in coords) - 1
+    z0 = min(z for _, z in coords) - 1
+    nx = max(x for x, _ in coords) + 2 - x0
+    nz = max(z for _, z in coords) + 2 - z0
+    around = list(itertools.product(xrange(x0, x0 + nx), xrange(z0, z0 + nz)))
+    bottom = min(lows[coord] for coord in around if coord in lows)
+    
+    # Anything not relit absorbs more than any light, missing chunks stay dark
+    shape = (16*nx, 16*nz, height - bottom)
+    absorbs = numpy.empty(shape, numpy.int16)
+    absorbs.fill(max_light + 1)
+    block = numpy.zeros(shape, numpy.int16)
+    kept_sky = numpy.zeros(shape, numpy.int16)
+    
+    for x, z in around:
+        if not level.containsChunk(x, z):
+            continue
+        
+        chunk = level.getChunk(x, z)
+        column = (slice(16*(x - x0), 16*(x - x0 + 1)), slice(16*(z - z0), 16*(z - z0 + 1)))
+        low = lows.get((x, z), height)
+        kept = column + (slice(0, low - bottom),)
+        relit = column + (slice(low - bottom, None),)
+        
+        block[kept] = chunk.BlockLight[..., bottom:low]
+        kept_sky[kept] = chunk.SkyLight[..., bottom:low]
+        blocks = chunk.Blocks[..., low:]
+        absorbs[relit] = absorption[blocks]
+        block[relit] = emission[blocks]
+    
+    fixed = absorbs > max_light
+    dimming = numpy.clip(absorbs, 1, None)
+    spread(block, dimming)
+    if sky:
+        lit = numpy.where(fixed, kept_sky, sky_light(absorbs))
+        spread(lit, dimming)
+    else:
+        lit = kept_sky
+    
+    lights = {}
+    for x, z in coords:
+        relit = (slice(16*(x - x0), 16*(x - x0 + 1)), slice(16*(z - z0), 16*(z - z0 + 1)),
+                 slice(lows[(x, z)] - bottom, None))
+        lights[(x, z)] = (lit[relit].astype(numpy.uint8), block[relit].astype(numpy.uint8))
+    
+    return lights
+
+def with_margin(level, lows):
+    """
+    Adds the chunks around those being relit, each chunk is then
+    relit from the lowest layer relit in any chunk next to it.
+    """
+    
+    around = {}
+    for (x, z), low in lows.iteritems():
+        for dx, dz in itertools.product((-1, 0, 1), (-1, 0, 1)):
+            coord = (x + dx, z + dz)
+            if level.containsChunk(*coord):
+                around[coord] = min(low, around.get(coord, low))
+    
+    return around
+
+def tiles(coords):
+    """ Groups chunks into the tiles they are relit in """
+    
+    grouped = collections.defaultdict(list)
+    for coord in coords:
+        grouped[(coord[0] // tile_size, coord[1] // tile_size)].append(coord)
+    
+    return [grouped[tile] for tile in sorted(grouped)]
+
+def store(level, lows, lights):
+    """ Gives chunks the light found for them from their lowest relit layer up """
+    
+    for coord, (skylight, blocklight) in lights.iteritems():
+        chunk = level.getChunk(*coord)
+        low = lows[coord]
+        chunk.SkyLight[..., low:] = skylight
+        chunk.BlockLight[..., low:] = blocklight
+        chunk.dirty = True
+
+def relight(level, lows):
+    """
+    Relights chunks from the lowest layers given in the 'lows'
+    mapping up, a tile of chunks at a time. Light below these
+    layers and in any other chunks is left as it is. Returns the
+    number of chunks relit.
+    """
+    
+    tables = light_tables(level.materials)
+    for tile in tiles(lows):
+        store(level, lows, light_tile(level, tile, lows, tables))
+    
+    return len(lows)
@@ -1,9 +1,9 @@
 #!/usr/bin/env python
 
-import sys, os.path, errno, logging
+import sys, os.path, errno, logging, multiprocessing
 import ancillary, cli, filter
 from various import Shifter, Relighter
-from contour import Contour, ContourLoadError
+from contour import Contour, ContourLoadError, HeightCache
 from merge import ChunkShaper, Merger
 
 logging.basicConfig(format="... %(message)s")
@@ -27,6 +27,8 @@ def get_contour(reset=False):
     return contour
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    
     # Values and helpers
     class Modes(object):
        __metaclass__ = ancillary.Enum
@@ -199,6 +201,17 @@ if __name__ == '__main__':
             except EnvironmentError, e:
                 error('could not read world data: %s' % e)
             
+            height_cache = None
+            height_cache_file = os.path.join(cli.world_dir, cli.height_cache_file_name)
+            if cli.height_cache:
+                height_cache = HeightCache(cli.height_cache_size)
+                try:
+                    height_cache.read(height_cache_file)
+                except (EnvironmentError, ContourLoadError), e:
+                    if getattr(e, 'errno', None) != errno.ENOENT:
+                        print "Ignoring height cache: %s" % e
+                        print
+            
             print "Merging chunks:"
             print
             
@@ -209,7 +222,7 @@ if __name__ == '__main__':
                 print ("... %%%dd/%%d (%%.1f%%%%)" % width) % (n, total, 100.0*n/total)
             merge.log_interval = 10
             merge.log_function = progress
-            reshaped = merge.erode(contour)
+            reshaped = merge.erode(contour, height_cache)
             
             print
             print "Relighting and saving:"
@@ -224,6 +237,23 @@ if __name__ == '__main__':
             print
             print "Finished merging, merged: %d/%d chunks" % (sum(len(x) for x in reshaped.itervalues()), total)
             
+            lookups = merge.height_hits + merge.height_misses
+            if lookups:
+                print "Height map reuse: %d/%d (%.1f%%)" % (merge.height_hits, lookups, 100.0*merge.height_hits/lookups)
+            if height_cache is not None and height_cache.hits + height_cache.misses:
+                print "Height cache hits: %d/%d" % (height_cache.hits, height_cache.hits + height_cache.misses)
+            if merge.mask_hits + merge.mask_misses:
+                print "Valley mask cache hits: %d/%d" % (merge.mask_hits, merge.mask_hits + merge.mask_misses)
+            if merge.series_hits + merge.series_misses:
+                print "River meander cache hits: %d/%d" % (merge.series_hits, merge.series_hits + merge.series_misses)
+            
+            if height_cache is not None:
+                print "Updating height cache"
+                try:
+                    height_cache.write(height_cache_file)
+                except EnvironmentError, e:
+                    print "Could not write height cache: %s" % e
+            
             print "Updating contour data"
             mask = reduce(lambda a, x: a | x, active, 0)
             for method, coords in reshaped.iteritems():
@@ -243,7 +273,7 @@ if __name__ == '__main__':
         except EnvironmentError, e:
             error('could not read world data: %s' % e)
         
-        print "Marking and relighting chunks:"
+        print "Relighting chunks:"
         print
         
         pymclevel_log.setLevel(logging.INFO)
@@ -262,6 +292,26 @@ if __name__ == '__main__':
         print
         print "Finished relighting, relit: %d chunks" % relit
     
+    # Rewrite the contour file in another format
+    elif mode == Modes.convert:
+        contour_data_file = os.path.join(cli.world_dir, cli.contour_file_name)
+        output_file = contour_data_file if cli.convert_output is None else os.path.join(cli.world_dir, cli.convert_output)
+        
+        print "Getting saved world contour..."
+        contour = Contour()
+        try:
+            contour.read(contour_data_file)
+        except (EnvironmentError, ContourLoadError), e:
+            error('could not read contour data: %s' % e)
+        
+        print "Recording world contour data..."
+        try:
+            contour.write(output_file, cli.convert_version)
+        except EnvironmentError, e:
+            error('could not write world contour data: %s' % e)
+        
+        print "Converted contour data to version %d" % cli.convert_version
+    
     # Should have found the right mode already!
     else:
         error("something went horribly wrong performing mode '%s'" % mode)
@@ -1,8 +1,8 @@
-import itertools, collections
+import itertools, collections, multiprocessing
 import numpy
 from pymclevel import mclevel
 import pymclevel.materials
-import ancillary, carve, filter, vec
+import ancillary, carve, filter, light
 from contour import Contour, HeightMap, EdgeData
 from carve import ChunkSeed
 
@@ -34,7 +34,6 @@ class ChunkShaper(object):
         self.__chunk = chunk
         self.__height_map = height_map
         self.__edge = edge
-        self.__edge_direction = vec.tuples2vecs(self.__edge.direction)
         self.__desert = False
         self.__ocean = False
         self.__dry = False
@@ -42,6 +41,7 @@ class ChunkShaper(object):
         self.__local_data = chunk.Data.copy()
         self.__seeder = ChunkSeed(chunk.world.RandomSeed, chunk.chunkPosition)
         self.__padding = padding
+        self.lowest = None
         
         self.__height_invalid = True
         self.height     # Initialise the height value
@@ -53,6 +53,17 @@ class ChunkShaper(object):
     @staticmethod
     def filt_is_even(name):
         return name in ('even', 'tidy')
+    
+    @classmethod
+    def filt_settings(cls, method):
+        """ Name and factor of the filter smoothing chunks for a shaping method """
+        
+        if cls.filt_is_river(method):
+            return cls.filt_name_river, cls.filt_factor_river
+        elif cls.filt_is_even(method):
+            return cls.filt_name_river, cls.filt_factor_even
+        else:
+            raise KeyError("invalid shaping method: '%s'" % method)
         
     @property
     def height(self):
@@ -66,8 +77,8 @@ class ChunkShaper(object):
         """ Carve out unsmoothed river bed """
         
         mx, mz = height.shape
-        mask1 = carve.make_mask((mx, mz), self.__edge_direction, self.river_width - 1, self.__seeder)
-        mask2 = carve.make_mask((mx, mz), self.__edge_direction, self.river_width,     self.__seeder)
+        mask1 = carve.make_mask((mx, mz), self.__edge.direction, self.river_width - 1, self.__seeder)
+        mask2 = carve.make_mask((mx, mz), self.__edge.direction, self.river_width,     self.__seeder)
         res = numpy.empty((mx, mz), height.dtype)
         for x in xrange(0, mx):
             for z in xrange(0, mz):
@@ -84,7 +95,7 @@ class ChunkShaper(object):
         """ Carve out area which will slope down to river """
         
         mx, mz = height.shape
-        mask = carve.make_mask((mx, mz), self.__edge_direction, self.valley_width, None)
+        mask = carve.make_mask((mx, mz), self.__edge.direction, self.valley_width, None)
         res = numpy.empty((mx, mz), height.dtype)
         for x in xrange(0, mx):
             for z in xrange(0, mz):
@@ -92,24 +103,59 @@ class ChunkShaper(object):
         
         return res, mask
     
-    def reshape(self, method):
-        """ Reshape the original chunk to the smoothed out result """
+    def reshapes(self, method):
+        """ Check if the chunk is reshaped by the shaping method """
+        
+        return bool(self.__edge.method & Contour.methods[method].bit)
+    
+    def padded(self, method):
+        """
+        Returns the padded height map that gets smoothed when
+        reshaping with the given method. This allows it to be
+        smoothed along with other chunks and handed to reshape.
+        """
+        
+        if self.filt_is_river(method):
+            valley, self.__erode_mask = self.with_valley(self.height)
+            return filter.pad(self.with_river(valley), self.__padding)
+        elif self.filt_is_even(method):
+            return self.chunk_padder(self.height, self.__padding)
+        else:
+            raise KeyError("invalid shaping method: '%s'" % method)
+    
+    def reshape(self, method, smoothed=None):
+        """
+        Reshape the original chunk to the smoothed out result. The
+        result of smoothing the padded height map can be given if
+        it was already found. The lowest height before or after
+        reshaping is kept, nothing beneath it has changed other
+        than the cover shifted down onto the new surface.
+        """
         
-        if self.__edge.method & Contour.methods[method].bit:
+        if self.reshapes(method):
             self.__desert = bool(self.__edge.method & Contour.methods['desert'].bit)
             self.__ocean = bool(self.__edge.method & Contour.methods['ocean'].bit)
             self.__dry = bool(self.__edge.method & Contour.methods['dry'].bit)
-            self.__shape(method)
+            lowest = self.height.min()
+            self.__shape(method, smoothed)
+            self.lowest = int(max(0, min(lowest, self.height.min()) - self.shift_depth))
             self.__chunk.chunkChanged()
         
-    def __shape(self, method):
+    def __shape(self, method, smoothed):
         """ Does the reshaping work for a specific shaping method """
         
+        if smoothed is not None:
+            smoothed = numpy.cast[self.height.dtype](numpy.round(smoothed))
+        
         if self.filt_is_river(method):
-            smoothed, erode_mask = self.erode_valley(self.filt_name_river, self.filt_factor_river)
+            if smoothed is None:
+                smoothed, erode_mask = self.erode_valley(self.filt_name_river, self.filt_factor_river)
+            else:
+                erode_mask = self.__erode_mask
             self.remove(smoothed, erode_mask)
         elif self.filt_is_even(method):
-            smoothed = self.erode_slope(self.filt_name_river, self.filt_factor_even)
+            if smoothed is None:
+                smoothed = self.erode_slope(self.filt_name_river, self.filt_factor_even)
             self.elevate(smoothed)
             self.remove(smoothed, None)
         else:
@@ -179,43 +225,53 @@ class ChunkShaper(object):
     def elevate(self, smoothed):
         """ Add chunk blocks until they reach provided height map """
 
-        # Erode blocks based on the height map
-        mx, mz, my = self.__local_ids.shape
+        # Elevate blocks based on the height map
+        ids, data = self.__local_ids, self.__local_data
+        mx, mz, my = ids.shape
         materials = self.__chunk.world.materials
-        for x in xrange(0, mx):
-            for z in xrange(0, mz):
-                local_columns = self.__local_ids[x, z], self.__local_data[x, z]
-                
-                # Get target height, make sure it's in the chunk
-                target = max(smoothed[x, z], self.height[x, z])
-                if target > my - 1:
-                    target = my - 1
-                    
-                # Collect details about blocks on the surface
-                initial = self.height[x, z]
-                below = self.__get_block(local_columns, initial)
-                above = self.__get_block(local_columns, initial + 1) if initial + 1 < my else None
-                supported_layer = self.__supported_blocks(local_columns, x, z, initial, below[0])
-                
-                # Extend the surface
-                deep = materials.Dirt if self.__block_equal(below, materials.Grass) else below
-                self.__replace((x, z, target), initial - target - 1, None, [below, deep])
-                if target + 1 < my:
-                    # Chop tree base if any shifting up occured
-                    top = self.__get_block(local_columns, target + 1)
-                    if  target > initial \
-                    and above[0] in self.__block_roles.tree_trunks \
-                    and top[0] not in self.__block_roles.tree_trunks:
-                        # Replace with sapling
-                        if not self.__place_sapling((x, z, target + 1), above):
-                            self.__place((x, z, target + 1), self.__empty_block(target + 1))
-                    
-                    # Place supported blocks
-                    else:
-                        for i, block in enumerate(supported_layer):
-                            self.__place((x, z, target + i + 1), block)
-                    
-                self.height[x, z] = target
+        tables = self.__block_roles.tables
+        xs, zs = numpy.indices((mx, mz))
+        ys = numpy.arange(my)
+        column = lambda a: a[..., numpy.newaxis]
+        
+        # Get target height, make sure it's in the chunk
+        initial = self.height.copy()
+        target = numpy.minimum(numpy.maximum(smoothed, initial), my - 1)
+        
+        # Collect details about blocks on the surface
+        below_ids, below_data = ids[xs, zs, initial % my], data[xs, zs, initial % my]
+        y1 = numpy.clip(initial + 1, 0, my - 1)
+        above_ids, above_data = ids[xs, zs, y1], data[xs, zs, y1]
+        supported = self.__supported_count(initial)
+        layers = [(ids[xs, zs, y], data[xs, zs, y]) for y in (numpy.clip(initial + i, 0, my - 1) for i in (1, 2))]
+        yt = numpy.clip(target + 1, 0, my - 1)
+        top_ids = ids[xs, zs, yt]
+        
+        # Extend the surface, the new top block is the old surface block and
+        # the rest is filled in with what should be found deeper down
+        grass = (below_ids == materials.Grass.ID) & (below_data == materials.Grass.blockData)
+        deep_ids = numpy.where(grass, materials.Dirt.ID, below_ids)
+        deep_data = numpy.where(grass, materials.Dirt.blockData, below_data)
+        fill = (ys >= column(initial)) & (ys <= column(target)) & ~tables.immutable[ids]
+        surface = fill & (numpy.cumsum(fill[..., ::-1], axis=2)[..., ::-1] == 1)
+        ids[...] = numpy.where(fill, numpy.where(surface, column(below_ids), column(deep_ids)), ids)
+        data[...] = numpy.where(fill, numpy.where(surface, column(below_data), column(deep_data)), data)
+        
+        # Chop tree base if any shifting up occured
+        inside = target + 1 < my
+        chop = inside & (target > initial) & tables.tree_trunks[above_ids] & ~tables.tree_trunks[top_ids]
+        for x, z in itertools.izip(*chop.nonzero()):
+            # Replace with sapling
+            if not self.__place_sapling((x, z, target[x, z] + 1), (int(above_ids[x, z]), int(above_data[x, z]))):
+                self.__place((x, z, target[x, z] + 1), self.__empty_block(target[x, z] + 1))
+        
+        # Place supported blocks
+        for i, (layer_ids, layer_data) in enumerate(layers):
+            place = inside & ~chop & (supported > i) & (target + i + 1 < my)
+            ids[xs[place], zs[place], target[place] + i + 1] = layer_ids[place]
+            data[xs[place], zs[place], target[place] + i + 1] = layer_data[place]
+        
+        self.height[...] = target
         
     def remove(self, smoothed, valley_mask=None):
         """ Remove chunk blocks according to provided height map. """
@@ -224,140 +280,277 @@ class ChunkShaper(object):
         mx, mz, my = self.__local_ids.shape
         removed = numpy.zeros((mx, mz), bool)
         materials = self.__chunk.world.materials
-        for x in xrange(0, mx):
-            for z in xrange(0, mz):
-                local_columns = self.__local_ids[x, z], self.__local_data[x, z]
-                initial = self.height[x, z]
-                target = min(smoothed[x, z], self.height[x, z])
-                
-                below = self.__get_block(local_columns, initial)
-                top_layer = [self.__get_block(local_columns, yi)
-                             for yi in xrange(initial, initial - self.shift_depth, -1)
-                             if yi >= 0]
-                supported_layer = self.__supported_blocks(local_columns, x, z, initial, below[0])
-                
-                for n, y in enumerate(xrange(target + 1, my)):
-                    curr_id, curr_data = self.__get_block(local_columns, y)
-                    empty = self.__empty_block(y)
-                    
-                    # Eliminate hovering trees but retain the rest
-                    if n > 0 and curr_id in self.__block_roles.tree_trunks:
-                        under_id = int(local_columns[0][y - 1])
-                        if under_id not in self.__block_roles.tree_trunks:
-                            # Remove tree trunk
-                            self.__place((x, z, y), empty)
-                            
-                            # Replace with sapling if this looks like the main tree trunk
-                            if y + 1 < my and (curr_id, curr_data) == self.__get_block(local_columns, y + 1):
-                                if not self.__place_sapling((x, z, target + 1), (curr_id, curr_data)):
-                                    self.__place((x, z, target + 1), self.__empty_block(target + 1))
-                    
-                    elif curr_id in self.__block_roles.update:
-                        # Mark leaves to be updated when the game loads this map
-                        self.__local_data[x, z, y] |= 8
-                    
-                    elif curr_id in self.__block_roles.tree_trunks:
-                        continue
-                    
-                    # Otherwise remove the block
-                    elif curr_id != empty.ID:
-                        # Remove if removable
-                        if curr_id not in self.__block_roles.immutable:
-                            # Decide which block to replace current block with
-                            if n < len(supported_layer):
-                                supported_id = supported_layer[n]
-                                
-                                # Find supported blocks to disolve
-                                if  empty.ID in self.__block_roles.solvent \
-                                and supported_id in self.__block_roles.disolve:
-                                    replace = self.__block_roles.disolve[supported_id]
-                                    new = empty if replace is None else replace
-                                    
-                                # Don't dissolve supported block
-                                else:
-                                    # Special case, removing blocks to make shorelines look normal
-                                    if y == self.sea_level:
-                                        new = empty
-                                    
-                                    # Supported block retained
-                                    else:
-                                        new = self.__get_block(local_columns, initial + 1)
-                                
-                                # Supported blocks must always be on other supporting blocks
-                                if new is empty:
-                                    supported_layer = supported_layer[0:n]
-                            elif not self.__desert and y <= self.sea_level and curr_id in self.__block_roles.water:
-                                new = None      # Don't remove water below sea level except in deserts
-                            else:
-                                new = empty
-                            
-                            # Replace current block
-                            if new is not None:
-                                self.__place((x, z, y), new)
-                        else:
-                            new = None
-                        
-                        # Extra work if first layer
-                        if n == 0:
-                            # Disolve top block in top layer if found to be underwater
-                            if (curr_id if new is None else new) in self.__block_roles.solvent:
-                                if len(top_layer) > 0 and top_layer[0][0] in self.__block_roles.disolve:
-                                    replace = self.__block_roles.disolve[top_layer[0][0]]
-                                    if replace is not None:
-                                        top_layer[0] = replace
-                        
-                            # Pretty things up a little where we've stripped things away
-                            removed[x, z] = True
-                            
-                            if y - 1 >= 0:
-                                # River bed
-                                if valley_mask is not None and y - 1 <= self.sea_level:
-                                    self.__replace((x, z, y - 1), -2, None, [materials.Sand])    # River bed
-                                
-                                # Shift down higher blocks
-                                elif top_layer:
-                                    self.__replace((x, z, y - 1), -len(top_layer), None, top_layer)
-                                
-                                # Bare dirt to grass
-                                if below[0] == materials.Dirt.ID:
-                                    self.__place((x, z, y - 1), materials.Grass)
+        tables = self.__block_roles.tables
+        target = numpy.minimum(smoothed, self.height)
+        
+        # Hovering tree trunks are trimmed depending on what has been removed
+        # beneath them so those columns have to be eroded block by block
+        above = numpy.arange(my) > target[..., numpy.newaxis]
+        special = (tables.tree_trunks[self.__local_ids] & above).any(axis=2) | (target < -1)
+        for x, z in itertools.izip(*special.nonzero()):
+            self.__remove_column(x, z, smoothed, valley_mask, removed)
+        
+        # All the other columns are eroded together
+        self.__remove_columns(~special, target, valley_mask, removed)
         
         ### Some improvements can only be made after all the blocks are eroded ###
         
         # Add river water
-        riverbed_material = [materials.Air if self.__dry else materials.Water]
+        riverbed_material = materials.Air if self.__dry else materials.Water
         if valley_mask is not None:
-            for x in xrange(0, mx):
-                for z in xrange(0, mz):
-                    # Skip if this areas was untouched
-                    if not valley_mask[x, z] and not removed[x, z]:
-                        continue
-
-                    # Get our bearings
-                    y = min(smoothed[x, z], self.height[x, z]) + 1
-                        
-                    # River water
-                    if y <= self.sea_level:
-                        self.__replace((x, z, y), self.sea_level - y + 1, None, riverbed_material)  # River water
+            # Only where areas were touched
+            ys = numpy.arange(my)
+            fill = (valley_mask | removed)[..., numpy.newaxis] \
+                 & (ys >= target[..., numpy.newaxis] + 1) & (target[..., numpy.newaxis] + 1 >= 0) \
+                 & (ys <= self.sea_level) & ~tables.immutable[self.__local_ids]
+            self.__local_ids[fill] = riverbed_material.ID
+            self.__local_data[fill] = riverbed_material.blockData
         
         self.__chunk.Blocks.data = self.__local_ids.data
         self.__chunk.Data.data = self.__local_data.data
         self.__height_invalid = True
+    
+    def __remove_columns(self, columns, target, valley_mask, removed):
+        """
+        Removes blocks above the target heights in all the selected
+        columns at once. The columns must not contain tree trunks above
+        the target height.
+        """
+        
+        ids, data = self.__local_ids, self.__local_data
+        mx, mz, my = ids.shape
+        materials = self.__chunk.world.materials
+        tables = self.__block_roles.tables
+        xs, zs = numpy.indices((mx, mz))
+        ys = numpy.arange(my)
+        sea = self.sea_level
+        initial = self.height
+        column = lambda a: a[..., numpy.newaxis]
+        
+        # Collect details about the original surface
+        below_ids = ids[xs, zs, initial % my]
+        top_len = numpy.clip(initial + 1, 0, self.shift_depth)
+        top_ys = numpy.clip(column(initial) - numpy.arange(self.shift_depth), 0, my - 1)
+        top_ids, top_data = ids[column(xs), column(zs), top_ys], data[column(xs), column(zs), top_ys]
+        
+        # Only supported blocks will be kept on the new surface
+        y1 = numpy.clip(initial + 1, 0, my - 1)
+        surface_ids, surface_data = ids[xs, zs, y1], data[xs, zs, y1]
+        supported = self.__supported_count(initial)
+        
+        # Blocks corresponding to emptiness at each height
+        flooded = ys <= sea if self.__ocean else numpy.zeros(my, bool)
+        empty_ids = numpy.where(flooded, materials.Water.ID, materials.Air.ID)
+        empty_data = numpy.where(flooded, materials.Water.blockData, materials.Air.blockData)
+        
+        # Classify every block above the target height
+        n = ys - column(target) - 1
+        active = column(columns) & (n >= 0)
+        update = active & tables.update[ids]
+        solid = active & ~update & (ids != empty_ids)
+        rest = solid & ~tables.immutable[ids]
+        
+        # Supported blocks are retained unless removed at the shoreline, after which
+        # any supported blocks remaining above would have nothing to stand on
+        if 0 <= sea < my:
+            n_sea = sea - target - 1
+            shore = rest[..., sea] & (n_sea >= 0) & (n_sea < supported)
+        else:
+            shore = numpy.zeros((mx, mz), bool)
+        retain = rest & (n < column(supported)) & ~(column(shore) & (ys > sea))
+        resurface = retain & (ys != sea)
+        
+        # Don't remove water below sea level except in deserts
+        if self.__desert:
+            keep = numpy.zeros(ids.shape, bool)
+        else:
+            keep = rest & ~retain & (ys <= sea) & tables.water[ids]
+        clear = rest & ~resurface & ~keep
+        
+        # Extra work needed for the first layer
+        first = numpy.zeros((mx, mz), bool)
+        dissolve = numpy.zeros((mx, mz), bool)
+        y0 = target + 1
+        within = (y0 >= 0) & (y0 < my)
+        y0c = numpy.clip(y0, 0, my - 1)
+        first[within] = solid[xs, zs, y0c][within]
+        kept = keep | (solid & ~rest)
+        dissolve[within] = kept[xs, zs, y0c][within] & tables.solvent[ids[xs, zs, y0c]][within]
+        
+        # Do the erosion
+        data[update] |= 8
+        ids[...] = numpy.where(clear, empty_ids, numpy.where(resurface, column(surface_ids), ids))
+        data[...] = numpy.where(clear, empty_data, numpy.where(resurface, column(surface_data), data))
+        
+        # Disolve top block in top layer if found to be underwater
+        if self.shift_depth > 0:
+            dissolve &= (top_len > 0) & (tables.disolve_ids[top_ids[..., 0]] >= 0)
+            top_data[..., 0] = numpy.where(dissolve, tables.disolve_data[top_ids[..., 0]], top_data[..., 0])
+            top_ids[..., 0] = numpy.where(dissolve, tables.disolve_ids[top_ids[..., 0]], top_ids[..., 0])
+        
+        # Pretty things up a little where we've stripped things away
+        removed |= first
+        first &= target >= 0
+        bed = first & (target <= sea) if valley_mask is not None else numpy.zeros((mx, mz), bool)
+        shift = first & ~bed & (top_len > 0)
+        
+        # River bed
+        for k in xrange(0, 2):
+            y = numpy.clip(target - k, 0, my - 1)
+            place = bed & (target - k >= 0) & ~tables.immutable[ids[xs, zs, y]]
+            ids[xs[place], zs[place], y[place]] = materials.Sand.ID
+            data[xs[place], zs[place], y[place]] = materials.Sand.blockData
+        
+        # Shift down higher blocks, immutable blocks are passed over
+        placed = numpy.zeros((mx, mz), int)
+        for k in xrange(0, self.shift_depth):
+            y = numpy.clip(target - k, 0, my - 1)
+            place = shift & (k < top_len) & (target - k >= 0) & ~tables.immutable[ids[xs, zs, y]]
+            which = numpy.minimum(placed, top_len - 1)[place]
+            ids[xs[place], zs[place], y[place]] = top_ids[xs[place], zs[place], which]
+            data[xs[place], zs[place], y[place]] = top_data[xs[place], zs[place], which]
+            placed += place
+        
+        # Bare dirt to grass
+        grass = first & (below_ids == materials.Dirt.ID)
+        ids[xs[grass], zs[grass], target[grass]] = materials.Grass.ID
+        data[xs[grass], zs[grass], target[grass]] = materials.Grass.blockData
+    
+    def __remove_column(self, x, z, smoothed, valley_mask, removed):
+        """ Remove blocks of a single column according to provided height map. """
+        
+        my = self.__local_ids.shape[2]
+        tables = self.__block_roles.tables
+        local_columns = self.__local_ids[x, z], self.__local_data[x, z]
+        initial = self.height[x, z]
+        target = min(smoothed[x, z], self.height[x, z])
+        materials = self.__chunk.world.materials
+        
+        below = self.__get_block(local_columns, initial)
+        top_layer = [self.__get_block(local_columns, yi)
+                     for yi in xrange(initial, initial - self.shift_depth, -1)
+                     if yi >= 0]
+        supported_layer = self.__supported_blocks(local_columns, x, z, initial, below[0])
+        
+        for n, y in enumerate(xrange(target + 1, my)):
+            curr_id, curr_data = self.__get_block(local_columns, y)
+            empty = self.__empty_block(y)
+            
+            # Eliminate hovering trees but retain the rest
+            if n > 0 and tables.tree_trunks[curr_id]:
+                if not tables.tree_trunks[local_columns[0][y - 1]]:
+                    # Remove tree trunk
+                    self.__place((x, z, y), empty)
+                    
+                    # Replace with sapling if this looks like the main tree trunk
+                    if y + 1 < my and (curr_id, curr_data) == self.__get_block(local_columns, y + 1):
+                        if not self.__place_sapling((x, z, target + 1), (curr_id, curr_data)):
+                            self.__place((x, z, target + 1), self.__empty_block(target + 1))
+            
+            elif tables.update[curr_id]:
+                # Mark leaves to be updated when the game loads this map
+                self.__local_data[x, z, y] |= 8
+            
+            elif tables.tree_trunks[curr_id]:
+                continue
+            
+            # Otherwise remove the block
+            elif curr_id != empty.ID:
+                # Remove if removable
+                if not tables.immutable[curr_id]:
+                    # Decide which block to replace current block with
+                    if n < len(supported_layer):
+                        supported_id = supported_layer[n]
+                        
+                        # Find supported blocks to disolve
+                        if  empty.ID in self.__block_roles.solvent \
+                        and supported_id in self.__block_roles.disolve:
+                            replace = self.__block_roles.disolve[supported_id]
+                            new = empty if replace is None else replace
+                        
+                        # Don't dissolve supported block
+                        else:
+                            # Special case, removing blocks to make shorelines look normal
+                            if y == self.sea_level:
+                                new = empty
+                            
+                            # Supported block retained
+                            else:
+                                new = self.__get_block(local_columns, initial + 1)
+                        
+                        # Supported blocks must always be on other supporting blocks
+                        if new is empty:
+                            supported_layer = supported_layer[0:n]
+                    elif not self.__desert and y <= self.sea_level and tables.water[curr_id]:
+                        new = None      # Don't remove water below sea level except in deserts
+                    else:
+                        new = empty
+                    
+                    # Replace current block
+                    if new is not None:
+                        self.__place((x, z, y), new)
+                else:
+                    new = None
+                
+                # Extra work if first layer
+                if n == 0:
+                    # Disolve top block in top layer if found to be underwater
+                    if (curr_id if new is None else new) in self.__block_roles.solvent:
+                        if len(top_layer) > 0 and tables.disolve[top_layer[0][0]]:
+                            replace = self.__block_roles.disolve[top_layer[0][0]]
+                            if replace is not None:
+                                top_layer[0] = replace
+                    
+                    # Pretty things up a little where we've stripped things away
+                    removed[x, z] = True
+                    
+                    if y - 1 >= 0:
+                        # River bed
+                        if valley_mask is not None and y - 1 <= self.sea_level:
+                            self.__replace((x, z, y - 1), -2, None, [materials.Sand])    # River bed
+                        
+                        # Shift down higher blocks
+                        elif top_layer:
+                            self.__replace((x, z, y - 1), -len(top_layer), None, top_layer)
+                        
+                        # Bare dirt to grass
+                        if below[0] == materials.Dirt.ID:
+                            self.__place((x, z, y - 1), materials.Grass)
 
+    def __supported_count(self, y_top):
+        """
+        Finds how many supported blocks are found above the given
+        heights in each column of the chunk.
+        """
+        
+        ids = self.__local_ids
+        mx, mz, my = ids.shape
+        tables = self.__block_roles.tables
+        xs, zs = numpy.indices((mx, mz))
+        
+        below_ids = ids[xs, zs, y_top % my]
+        supporting = tables.terrain[below_ids] | tables.tree_trunks[below_ids] | tables.tree_leaves[below_ids]
+        supported1 = (y_top + 1 >= 0) & (y_top + 1 < my) & supporting \
+                   & tables.supported[ids[xs, zs, numpy.clip(y_top + 1, 0, my - 1)]]
+        supported2 = supported1 & (y_top + 2 < my) & tables.supported2[ids[xs, zs, numpy.clip(y_top + 2, 0, my - 1)]]
+        
+        return supported1.astype(int) + supported2
+    
     def __supported_blocks(self, local_columns, x, z, y_top, below_id):
         """Only supported blocks will be kept on the new surface"""
         
+        tables = self.__block_roles.tables
         above = []
         if self.__inchunk((x, z, y_top + 1)):
             block = self.__get_block(local_columns, y_top + 1)
-            if block[0] in self.__block_roles.supported \
-                    and (below_id in self.__block_roles.terrain or
-                         below_id in self.__block_roles.tree_trunks or
-                         below_id in self.__block_roles.tree_leaves):
+            if tables.supported[block[0]] \
+                    and (tables.terrain[below_id] or
+                         tables.tree_trunks[below_id] or
+                         tables.tree_leaves[below_id]):
                 above.append(block)
                 if self.__inchunk((x, z, y_top + 2)):
                     block = self.__get_block(local_columns, y_top + 2)
-                    if block[0] in self.__block_roles.supported2:
+                    if tables.supported2[block[0]]:
                         above.append(block)
         
         return above
@@ -397,13 +590,14 @@ class ChunkShaper(object):
         at the given coordinates in a column of specified height.
         """
         
+        tables = self.__block_roles.tables
         blocks = ancillary.extend(blocks)
         for y in xrange(coords[2], coords[2] + high, numpy.sign(high)):
             xzy = (coords[0], coords[1], y)
             if not self.__inchunk(xzy):
                 return
             if from_ids is None or int(self.__local_ids[xzy]) in from_ids:
-                if int(self.__local_ids[xzy]) not in self.__block_roles.immutable:    # Leave immutable blocks alone!
+                if not tables.immutable[self.__local_ids[xzy]]:    # Leave immutable blocks alone!
                     self.__place(xzy, blocks.next())
                     
     def __place_sapling(self, coords, tree_trunk):
@@ -427,8 +621,115 @@ class ChunkShaper(object):
                 return False
         return True
     
+# Kept at module level under their own names so they can be pickled into worker processes
+BlockRoleIDs = collections.namedtuple('BlockRoleIDs', [
+    'terrain', 'supported', 'supported2', 'immutable', 'solvent',
+    'disolve', 'water', 'tree_trunks', 'tree_leaves',
+    'tree_trunks_replace', 'update', 'tables',
+])
+
+# Dense lookup tables for the block roles, indexed by block ID (and block data
+# for the tree trunk replacements) so that whole chunks can be tested at once
+BlockRoleTables = collections.namedtuple('BlockRoleTables', [
+    'terrain', 'supported', 'supported2', 'immutable', 'solvent',
+    'disolve', 'disolve_ids', 'disolve_data', 'water', 'tree_trunks', 'tree_leaves',
+    'tree_trunks_replace', 'tree_trunks_replace_ids', 'tree_trunks_replace_data', 'update',
+])
+
+DetachedWorld = collections.namedtuple('DetachedWorld', ('RandomSeed', 'materials'))
+
+class DetachedChunk(object):
+    """
+    Stands in for a pymclevel chunk with copies of only the data
+    needed for reshaping, so chunks can be reshaped away from the
+    level they came from.
+    """
+    
+    def __init__(self, world, position, blocks, data):
+        self.world = world
+        self.chunkPosition = position
+        self.Blocks = blocks
+        self.Data = data
+        self.changed = False
+    
+    def chunkChanged(self):
+        self.changed = True
+
+# Settings which must be carried over into worker processes
+_shaper_attrs = ('river_width', 'valley_width', 'valey_height', 'river_height', 'sea_level', 'shift_depth',
+                 'filt_name_river', 'filt_factor_river', 'filt_name_even', 'filt_factor_even')
+_carve_attrs = ('narrowing_factor', 'corner_radius_offset', 'river_deviation_centre', 'river_deviation_width',
+                'river_frequency_centre', 'river_frequency_width')
+
+def _shaper_settings():
+    return (dict((name, getattr(ChunkShaper, name)) for name in _shaper_attrs),
+            dict((name, getattr(carve, name)) for name in _carve_attrs))
+
+_worker = None
+
+def _smooth_all(shapers, method, padding):
+    """
+    Smooths the height maps of all the chunks reshaped by the
+    shaping method in one go, when they use the 'smooth' filter.
+    Returns the result for each shaper, None for those that
+    will be smoothed on their own.
+    """
+    
+    smoothed = [None]*len(shapers)
+    filt_name, filt_factor = ChunkShaper.filt_settings(method)
+    if filter.filters[filt_name] == 'smooth':
+        index = [i for i, cs in enumerate(shapers) if cs.reshapes(method)]
+        if index:
+            stacked = filter.smooth_padded(numpy.array([shapers[i].padded(method) for i in index]), filt_factor, padding)
+            for i, result in itertools.izip(index, stacked):
+                smoothed[i] = result
+    
+    return smoothed
+
+def _init_worker(world, block_roles, settings):
+    """ Sets up a worker process for reshaping chunks """
+    
+    global _worker
+    
+    shaper_settings, carve_settings = settings
+    for name, val in shaper_settings.iteritems():
+        setattr(ChunkShaper, name, val)
+    for name, val in carve_settings.iteritems():
+        setattr(carve, name, val)
+        
+    _worker = (world, block_roles)
+
+def _reshape_jobs(method, padding, jobs):
+    """
+    Reshapes a group of detached chunks in a worker process. The
+    height maps of the surrounding chunks are given with each chunk.
+    """
+    
+    world, block_roles = _worker
+    
+    counts = carve.cache_counts()
+    chunks = []; shapers = []
+    for coord, edge_method, edge_direction, blocks, data, around in jobs:
+        chunk = DetachedChunk(world, coord, blocks, data)
+        chunks.append(chunk)
+        shapers.append(ChunkShaper(chunk, EdgeData(edge_method, edge_direction), padding, around, block_roles))
+    
+    results = []
+    for chunk, cs, smoothed in itertools.izip(chunks, shapers, _smooth_all(shapers, method, padding)):
+        cs.reshape(method, smoothed)
+        results.append((chunk.chunkPosition, chunk.Blocks, chunk.Data, chunk.changed, cs.lowest))
+    
+    return results, carve.cache_counts() - counts
+
 class Merger(object):
     relight = True
+    relight_band = False    # Only relight reshaped chunks and those around them, from the lowest height changed up
+    
+    jobs = 1            # Number of worker processes used to reshape chunks
+    job_group = 8       # Number of edge chunks reshaped together, or handed to a worker at a time
+    
+    chunk_budget = None # Number of reshaped chunks held before saving, None for no limit
+    region_size = 32    # Width of a region file in chunks, must be a power of two
     
     filt_radius_even = 1
     filt_padding_even = 2
@@ -855,18 +1156,15 @@ class Merger(object):
     update = tree_leaves + (
         'Vines',
     )
-
-    BlockRoleIDs = collections.namedtuple('BlockIDs', [
-        'terrain', 'supported', 'supported2', 'immutable', 'solvent',
-        'disolve', 'water', 'tree_trunks', 'tree_leaves',
-        'tree_trunks_replace', 'update',
-    ])
+    
+    block_ids = 4096
+    block_data = 16
     
     processing_order = ('even', 'river', 'tidy')
     
     def __init__(self, world_dir):
         self.__level = mclevel.fromFile(world_dir)
-        self.__block_roles = self.BlockRoleIDs(
+        block_roles = BlockRoleIDs(
             self.__block_material(self.terrain),
             self.__block_material(self.supported),
             self.__block_material(self.supported2),
@@ -878,10 +1176,21 @@ class Merger(object):
             self.__block_material(self.tree_leaves),
             self.__block_material(self.tree_trunks_replace, (('ID', 'blockData'), None)),
             self.__block_material(self.update),
+            None,
         )
+        self.__block_roles = block_roles._replace(tables=self.__block_tables(block_roles))
         
         self.log_interval = 1
         self.log_function = None
+        
+        self.height_hits = 0
+        self.height_misses = 0
+        self.mask_hits = 0
+        self.mask_misses = 0
+        self.series_hits = 0
+        self.series_misses = 0
+        
+        self.__lows = {}
     
     def __block_material(self, names, attrs='ID'):
         """
@@ -927,6 +1236,49 @@ class Merger(object):
             atr = getter(attrs)
             return set(atr(getname_or_none(materials, n)) for n in names if hasname_or_none(materials, n))
     
+    def __block_tables(self, block_roles):
+        """
+        Returns dense lookup tables for the given block roles. Roles which
+        are sets become boolean tables while the replacement mappings
+        also get tables with the replacement block IDs and block data.
+        """
+        
+        def lookup(ids):
+            table = numpy.zeros(self.block_ids, bool)
+            table[list(ids)] = True
+            return table
+        
+        disolve_ids = numpy.full(self.block_ids, -1, int)
+        disolve_data = numpy.zeros(self.block_ids, int)
+        for block_id, replace in block_roles.disolve.iteritems():
+            disolve_ids[block_id], disolve_data[block_id] = (-1, 0) if replace is None else replace
+        
+        shape = (self.block_ids, self.block_data)
+        replace_table = numpy.zeros(shape, bool)
+        replace_ids = numpy.zeros(shape, int)
+        replace_data = numpy.zeros(shape, int)
+        for block, sapling in block_roles.tree_trunks_replace.iteritems():
+            replace_table[block] = True
+            replace_ids[block], replace_data[block] = sapling.ID, sapling.blockData
+        
+        return BlockRoleTables(
+            lookup(block_roles.terrain),
+            lookup(block_roles.supported),
+            lookup(block_roles.supported2),
+            lookup(block_roles.immutable),
+            lookup(block_roles.solvent),
+            lookup(block_roles.disolve),
+            disolve_ids,
+            disolve_data,
+            lookup(block_roles.water),
+            lookup(block_roles.tree_trunks),
+            lookup(block_roles.tree_leaves),
+            replace_table,
+            replace_ids,
+            replace_data,
+            lookup(block_roles.update),
+        )
+    
     def __give_surrounding(self, coords, radius):
         """ List all surrounding chunks including the centre """
         
@@ -943,39 +1295,68 @@ class Merger(object):
                 return False
         return True
     
-    def erode(self, contour):
+    def erode(self, contour, height_cache=None):
         # Requisite objects
-        height_map = contour.height_map(self.__level, self.__block_roles)
+        height_map = contour.height_map(self.__level, self.__block_roles, height_cache)
+        pool = self.__pool() if self.jobs > 1 else None
+        self.__carve_counts = -carve.cache_counts()
+        try:
+            return self.__erode(contour, height_map, pool)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            
+            # Keep track of how well height maps and carved masks were reused
+            self.height_hits = height_map.hits
+            self.height_misses = height_map.misses
+            self.__carve_counts += carve.cache_counts()
+            self.mask_hits, self.mask_misses, self.series_hits, self.series_misses = self.__carve_counts.tolist()
         
-        # Go through each processing method in turn
-        reshaped = {}; n = 0
+    def __erode(self, contour, height_map, pool):
+        # Find the edges each processing method has to deal with
+        stages = []
         for method in self.processing_order:
             method_bit = Contour.methods[method].bit
+            
+            # Check if we have to deal with surrounding chunks
+            if ChunkShaper.filt_is_even(method):
+                radius = self.filt_radius_even
+                padding = self.filt_padding_even
+            else:
+                radius = self.filt_radius_river
+                padding = self.filt_padding_river
+            
+            # We only re-shape when surrounding chunks are present to prevent river spillage
+            # and ensure padding requirements can be fulfilled
+            coords = [k for k, v in contour.edges.iteritems() if v.method & method_bit != 0]
+            ready = set(coord for coord in coords if self.__have_surrounding(coord, radius + padding))
+            
+            # Go through the edges along a Z-order curve so neighbouring chunks are reshaped
+            # close together, this also keeps the edges of each region together
+            coords.sort(key=ancillary.morton)
+            
+            # Height maps are only kept while pending edges still need them
+            for coord in ready:
+                height_map.reference(self.__give_surrounding(coord, radius + padding))
+                
+            stages.append((method, radius, padding, coords, ready))
+        
+        # Go through each processing method in turn
+        reshaped = {}; n = 0
+        touched = set()
+        for method, radius, padding, coords, ready in stages:
             reshaped[method] = []
             
-            # Go through all the chunks that require processing
-            processed = set()
-            for coord in (k for k, v in contour.edges.iteritems() if v.method & method_bit != 0):
-                # Progress logging
-                if self.log_function is not None:
-                    if n % self.log_interval == 0:
-                        self.log_function(n)
-
-                # Check if we have to deal with surrounding chunks
-                if ChunkShaper.filt_is_even(method):
-                    radius = self.filt_radius_even
-                    padding = self.filt_padding_even
-                else:
-                    radius = self.filt_radius_river
-                    padding = self.filt_padding_river
-                    
-                # We only re-shape when surrounding chunks are present to prevent river spillage
-                # and ensure padding requirements can be fulfilled
-                if self.__have_surrounding(coord, radius + padding):
-                    def reshape(chunk):
+            # Plan out which chunks get reshaped around each edge chunk
+            plan = []; processed = set()
+            for coord in coords:
+                tasks = []
+                if coord in ready:
+                    for chunk in self.__give_surrounding(coord, radius):
                         # Don't re-process anything
                         if chunk in processed:
-                            return
+                            continue
                         
                         # Process central chunk
                         if chunk == coord:
@@ -986,23 +1367,41 @@ class Merger(object):
                         #       that is closest to one of the edge contour chunks.
                         else:
                             if chunk in contour.edges:
-                                return
+                                continue
                             else:
-                                edge = EdgeData(contour.edges[coord].method, set())
-                            
-                        # Do the processing
-                        cs = ChunkShaper(self.__level.getChunk(*chunk), edge, padding, height_map, self.__block_roles)
-                        cs.reshape(method)
+                                edge = EdgeData(contour.edges[coord].method, 0)
+                        
+                        tasks.append((chunk, edge))
                         processed.add(chunk)
-                        height_map.invalidations.add(chunk)
-                    
-                    for chunk in self.__give_surrounding(coord, radius):
-                        reshape(chunk)
                         
                     reshaped[method].append(coord)
+                plan.append(tasks)
+            
+            # Go through all the chunks that require processing, one batch at a time
+            for batch in self.__batches(coords, plan):
+                # Find all the height maps this batch will need in one go
+                height_map.prefetch(itertools.chain.from_iterable(
+                    self.__give_surrounding(coords[i], radius + padding) for i in batch if coords[i] in ready))
+                
+                batch_plan = [plan[i] for i in batch]
+                for _, i in itertools.izip(self.__reshape_all(batch_plan, method, padding, height_map, pool), batch):
+                    # Progress logging
+                    if self.log_function is not None:
+                        if n % self.log_interval == 0:
+                            self.log_function(n)
+                    
+                    # Count relevant chunks
+                    n += 1
+                    
+                    # Let go of height maps this edge no longer needs
+                    if coords[i] in ready:
+                        height_map.release(self.__give_surrounding(coords[i], radius + padding))
                 
-                # Count relevant chunks
-                n += 1
+                # Save and let go of reshaped chunks when streaming
+                if self.chunk_budget is not None:
+                    touched.update(chunk for tasks in batch_plan for chunk, _ in tasks)
+                    if len(touched) >= self.chunk_budget:
+                        self.__flush(touched)
             
             # Height map must be invalidated between stages
             height_map.invalidate_deferred()
@@ -1013,10 +1412,139 @@ class Merger(object):
         
         return reshaped
     
+    def __batches(self, coords, plan):
+        """
+        Splits the plan up into batches of plan indices. Without a chunk
+        budget all the edges are done in a single batch, otherwise a batch
+        never spans more than one region or reshapes more chunks than the
+        budget allows.
+        """
+        
+        if self.chunk_budget is None:
+            return [range(0, len(coords))]
+        
+        batches = []; batch = None; region = None; size = 0
+        for i, coord in enumerate(coords):
+            coord_region = (coord[0] // self.region_size, coord[1] // self.region_size)
+            if batch is None or coord_region != region or size >= self.chunk_budget:
+                batch = []; region = coord_region; size = 0
+                batches.append(batch)
+            batch.append(i)
+            size += len(plan[i])
+            
+        return batches
+    
+    def __flush(self, touched):
+        """
+        Relights and saves the reshaped chunks, then has the level let
+        go of every chunk it loaded. Chunks needed again are read back.
+        """
+        
+        if self.relight:
+            self.__relight(touched)
+        self.__level.saveInPlace()
+        self.__level.unload()
+        touched.clear()
+    
+    def __relight(self, touched=None):
+        """
+        Relights the chunks reshaped so far, or only those touched.
+        When relighting the band alone, light is only spread through
+        reshaped chunks and one chunk around them from the lowest
+        height changed up to the top of the map.
+        """
+        
+        if not self.relight_band:
+            if touched is None:
+                self.__level.generateLights()
+            else:
+                self.__level.generateLights(touched)
+            return
+        
+        if touched is None:
+            lows, self.__lows = self.__lows, {}
+        else:
+            lows = dict((coord, self.__lows.pop(coord)) for coord in touched if coord in self.__lows)
+        light.relight(self.__level, light.with_margin(self.__level, lows))
+    
+    def __lowered(self, coord, lowest):
+        """ Keep track of the lowest height changed in each reshaped chunk """
+        
+        if lowest is not None:
+            self.__lows[coord] = min(lowest, self.__lows.get(coord, lowest))
+    
+    def __reshape_all(self, plan, method, padding, height_map, pool):
+        """
+        Reshapes the planned chunks, yielding once for each edge
+        chunk in the plan as its reshaping is finished. Each chunk is
+        only reshaped from data present at the start of the stage,
+        so the work may be handed out to a worker pool.
+        """
+        
+        if pool is None:
+            for start in xrange(0, len(plan), self.job_group):
+                group = plan[start:start + self.job_group]
+                shapers = [[ChunkShaper(self.__level.getChunk(*chunk), edge, padding, height_map, self.__block_roles)
+                            for chunk, edge in tasks] for tasks in group]
+                smoothed = iter(_smooth_all(list(itertools.chain.from_iterable(shapers)), method, padding))
+                for tasks, task_shapers in itertools.izip(group, shapers):
+                    for (chunk, _), cs in itertools.izip(tasks, task_shapers):
+                        cs.reshape(method, next(smoothed))
+                        self.__lowered(chunk, cs.lowest)
+                        height_map.invalidations.add(chunk)
+                    yield
+            return
+        
+        def collect(group, result):
+            results, counts = result.get()
+            self.__carve_counts += counts
+            for coord, blocks, data, changed, lowest in results:
+                chunk = self.__level.getChunk(*coord)
+                chunk.Blocks[:] = blocks
+                chunk.Data[:] = data
+                if changed:
+                    chunk.chunkChanged()
+                self.__lowered(coord, lowest)
+                height_map.invalidations.add(coord)
+            
+            for _ in group:
+                yield
+        
+        # Keep a bounded number of groups in flight so that chunk data
+        # copies don't pile up in the pool queues
+        pending = collections.deque()
+        for start in xrange(0, len(plan), self.job_group):
+            group = plan[start:start + self.job_group]
+            jobs = []
+            for chunk, edge in itertools.chain.from_iterable(group):
+                level_chunk = self.__level.getChunk(*chunk)
+                around = dict((coord, height_map[coord]) for coord in self.__give_surrounding(chunk, padding) if coord != chunk)
+                jobs.append((chunk, edge.method, edge.direction, level_chunk.Blocks.copy(), level_chunk.Data.copy(), around))
+            pending.append((group, pool.apply_async(_reshape_jobs, (method, padding, jobs))))
+            
+            if len(pending) >= 2*self.jobs:
+                for x in collect(*pending.popleft()):
+                    yield x
+        
+        while pending:
+            for x in collect(*pending.popleft()):
+                yield x
+    
+    def __worker_args(self):
+        """ Arguments for setting up worker processes, these must all pickle """
+        
+        world = DetachedWorld(self.__level.RandomSeed, self.__level.materials)
+        return (world, self.__block_roles, _shaper_settings())
+    
+    def __pool(self):
+        """ Creates a worker pool for reshaping chunks in parallel """
+        
+        return multiprocessing.Pool(self.jobs, _init_worker, self.__worker_args())
+    
     def commit(self):
         """ Finalise and save map """
         
         if self.relight:
-            self.__level.generateLights()
+            self.__relight()
         self.__level.saveInPlace()
 
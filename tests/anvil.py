@@ -0,0 +1,198 @@
+"""
+Makes Anvil copies of the McRegion test worlds, the only format
+pymclevel now reads, so the tests have real chunks to work on.
+"""
+
+import os, glob, re, shutil, struct, zlib, gzip, StringIO
+import numpy
+
+testfiles = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'testfiles')
+
+anvil_version = 19133
+sector = 4096
+
+# NBT tags are held as (tag type, value) pairs, compounds as lists of (name, tag) pairs
+TAG_END, TAG_BYTE, TAG_SHORT, TAG_INT, TAG_LONG, TAG_FLOAT, TAG_DOUBLE = range(7)
+TAG_BYTE_ARRAY, TAG_STRING, TAG_LIST, TAG_COMPOUND, TAG_INT_ARRAY = range(7, 12)
+
+scalars = {TAG_BYTE: struct.Struct('>b'), TAG_SHORT: struct.Struct('>h'), TAG_INT: struct.Struct('>i'),
+           TAG_LONG: struct.Struct('>q'), TAG_FLOAT: struct.Struct('>f'), TAG_DOUBLE: struct.Struct('>d')}
+
+def read_value(data, pos, tag):
+    """ Reads an NBT value of the given type, returns it with the position after it """
+
+    if tag in scalars:
+        return scalars[tag].unpack_from(data, pos)[0], pos + scalars[tag].size
+    if tag == TAG_BYTE_ARRAY:
+        n, = struct.unpack_from('>i', data, pos)
+        return numpy.frombuffer(data, numpy.uint8, n, pos + 4).copy(), pos + 4 + n
+    if tag == TAG_INT_ARRAY:
+        n, = struct.unpack_from('>i', data, pos)
+        return numpy.frombuffer(data, '>i4', n, pos + 4).astype(numpy.int32), pos + 4 + 4*n
+    if tag == TAG_STRING:
+        n, = struct.unpack_from('>H', data, pos)
+        return data[pos + 2:pos + 2 + n], pos + 2 + n
+    if tag == TAG_LIST:
+        item, n = struct.unpack_from('>bi', data, pos)
+        pos += 5
+        items = []
+        for _ in xrange(n):
+            value, pos = read_value(data, pos, item)
+            items.append(value)
+        return (item, items), pos
+    if tag == TAG_COMPOUND:
+        entries = []
+        while True:
+            t = ord(data[pos])
+            pos += 1
+            if t == TAG_END:
+                return entries, pos
+            name, pos = read_value(data, pos, TAG_STRING)
+            value, pos = read_value(data, pos, t)
+            entries.append((name, (t, value)))
+    raise ValueError("unknown NBT tag %d" % tag)
+
+def write_value(out, tag, value):
+    """ Writes an NBT value of the given type to a list of strings """
+
+    if tag in scalars:
+        out.append(scalars[tag].pack(value))
+    elif tag == TAG_BYTE_ARRAY:
+        out.append(struct.pack('>i', len(value)))
+        out.append(numpy.asarray(value, numpy.uint8).tostring())
+    elif tag == TAG_INT_ARRAY:
+        out.append(struct.pack('>i', len(value)))
+        out.append(numpy.asarray(value, '>i4').tostring())
+    elif tag == TAG_STRING:
+        out.append(struct.pack('>H', len(value)))
+        out.append(value)
+    elif tag == TAG_LIST:
+        item, items = value
+        out.append(struct.pack('>bi', item, len(items)))
+        for v in items:
+            write_value(out, item, v)
+    elif tag == TAG_COMPOUND:
+        for name, (t, v) in value:
+            out.append(chr(t))
+            write_value(out, TAG_STRING, name)
+            write_value(out, t, v)
+        out.append(chr(TAG_END))
+    else:
+        raise ValueError("unknown NBT tag %d" % tag)
+
+def read_root(data):
+    """ Reads a named root compound, returns its name and entries """
+
+    name, pos = read_value(data, 1, TAG_STRING)
+    return name, read_value(data, pos, TAG_COMPOUND)[0]
+
+def write_root(name, entries):
+    out = [chr(TAG_COMPOUND)]
+    write_value(out, TAG_STRING, name)
+    write_value(out, TAG_COMPOUND, entries)
+    return ''.join(out)
+
+def region_chunks(file_name):
+    """ Yields the root compound of each chunk in a region file """
+
+    with open(file_name, 'rb') as f:
+        data = f.read()
+
+    for location in numpy.frombuffer(data, '>u4', 1024):
+        if location == 0:
+            continue
+
+        pos = (int(location) >> 8)*sector
+        length, compression = struct.unpack_from('>iB', data, pos)
+        raw = data[pos + 5:pos + 4 + length]
+        raw = zlib.decompress(raw) if compression == 2 else gzip.GzipFile(fileobj=StringIO.StringIO(raw)).read()
+        yield read_root(raw)
+
+def write_region(file_name, chunks):
+    """ Writes chunk root compounds keyed by their position in the region """
+
+    locations = numpy.zeros(1024, '>u4')
+    body = []
+    offset = 2
+    for (x, z), (name, entries) in sorted(chunks.iteritems()):
+        compressed = zlib.compress(write_root(name, entries))
+        data = struct.pack('>iB', len(compressed) + 1, 2) + compressed
+        data += '\0'*(-len(data) % sector)
+        locations[(x & 31) + 32*(z & 31)] = offset << 8 | len(data) // sector
+        offset += len(data) // sector
+        body.append(data)
+
+    with open(file_name, 'wb') as f:
+        f.write(locations.tostring())
+        f.write('\0'*sector)
+        f.write(''.join(body))
+
+def nibbles(packed, shape):
+    """ Unpacks an array of 4-bit values, the low half of each byte first """
+
+    values = numpy.empty(packed.size*2, numpy.uint8)
+    values[0::2] = packed & 15
+    values[1::2] = packed >> 4
+    return values.reshape(shape)
+
+def pack_nibbles(values):
+    values = numpy.ascontiguousarray(values, numpy.uint8).ravel()
+    return values[0::2] | (values[1::2] << 4)
+
+def anvil_level(level):
+    """ Turns the 'Level' compound of a McRegion chunk into that of an Anvil chunk """
+
+    old = dict(level)
+    height = old['Blocks'][1].size // 256
+    arrays = {'Blocks': old['Blocks'][1].reshape(16, 16, height)}
+    for name in ('Data', 'SkyLight', 'BlockLight'):
+        arrays[name] = nibbles(old[name][1], (16, 16, height))
+
+    # McRegion arrays are ordered XZY, Anvil section arrays YZX
+    sections = []
+    for y in xrange(height // 16):
+        layer = dict((name, array[..., 16*y:16*(y + 1)].transpose(2, 1, 0)) for name, array in arrays.iteritems())
+        sections.append([
+            ('Y', (TAG_BYTE, y)),
+            ('Blocks', (TAG_BYTE_ARRAY, numpy.ascontiguousarray(layer['Blocks']).ravel())),
+            ('Data', (TAG_BYTE_ARRAY, pack_nibbles(layer['Data']))),
+            ('SkyLight', (TAG_BYTE_ARRAY, pack_nibbles(layer['SkyLight']))),
+            ('BlockLight', (TAG_BYTE_ARRAY, pack_nibbles(layer['BlockLight']))),
+        ])
+
+    entries = [(name, old[name]) for name in ('xPos', 'zPos', 'LastUpdate', 'TerrainPopulated', 'Entities', 'TileEntities')
+               if name in old]
+    entries.append(('HeightMap', (TAG_INT_ARRAY, old['HeightMap'][1].astype(numpy.int32))))
+    entries.append(('Sections', (TAG_LIST, (TAG_COMPOUND, sections))))
+    return entries
+
+def anvil_world(world, world_dir):
+    """
+    Copies one of the McRegion test worlds to the given directory
+    with its region files and level.dat in Anvil format.
+    """
+
+    source = os.path.join(testfiles, world)
+    os.makedirs(os.path.join(world_dir, 'region'))
+    shutil.copy(os.path.join(source, 'session.lock'), world_dir)
+
+    with open(os.path.join(source, 'level.dat'), 'rb') as f:
+        name, entries = read_root(gzip.GzipFile(fileobj=f).read())
+    data = dict(entries)['Data'][1]
+    data[:] = [(n, (TAG_INT, anvil_version) if n == 'version' else v) for n, v in data]
+    with open(os.path.join(world_dir, 'level.dat'), 'wb') as f:
+        g = gzip.GzipFile(fileobj=f, mode='wb')
+        g.write(write_root(name, entries))
+        g.close()
+
+    for file_name in glob.glob(os.path.join(source, 'region', 'r.*.*.mcr')):
+        chunks = {}
+        for name, entries in region_chunks(file_name):
+            level = anvil_level(dict(entries)['Level'][1])
+            position = dict(level)
+            chunks[(position['xPos'][1], position['zPos'][1])] = (name, [('Level', (TAG_COMPOUND, level))])
+
+        region = re.sub(r'\.mcr$', '.mca', os.path.basename(file_name))
+        write_region(os.path.join(world_dir, 'region', region), chunks)
+
+    return world_dir
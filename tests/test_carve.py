@@ -0,0 +1,118 @@
+""" Checks the carved valley masks against the original point by point rasterisation """
+
+import os, sys, unittest, itertools
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import numpy
+import carve, vec
+
+# The original rasterisation, it works on lists of direction vectors
+
+def reference_trace_ellipse(centre, axes, bound=((0, 0), (15, 15))):
+    abs_axes = numpy.abs(numpy.array(axes)) - carve.corner_radius_offset
+    ax2, az2 = numpy.power(abs_axes, 2)
+    in_ellipse = lambda x, z: (float(x)**2/ax2 + float(z)**2/az2 < 1)
+    
+    upper = int(numpy.floor(abs_axes[1]))
+    for x in xrange(0, int(numpy.floor(abs_axes[0])) + 1):
+        for z in xrange(upper, -1, -1):
+            if in_ellipse(x, z):
+                upper = z
+                point = numpy.cast[int](centre + numpy.sign(axes)*numpy.array([x, z]))
+                if (numpy.array(bound[0]) <= point).all() and (numpy.array(bound[1]) >= point).all():
+                    yield point
+                break
+
+def reference_mask_lines(shape, limits, start=0, step=1):
+    a = numpy.zeros(shape, dtype=bool)
+    mx, my = shape
+    
+    x = start
+    for line in limits:
+        if x < 0 or x >= mx:
+            break
+        start = my if line[0] > my else line[0]
+        end   = my if line[1] > my else line[1]
+        a.data[mx*x+start:mx*x+end] = '\x01'*(end - start)
+        x += step
+        
+    return a
+
+def reference_mask_edge(shape, v, widths):
+    axis = 0 if v[0] != 0 else 1
+    limits = ((0, x) for x in widths) if any(v < 0) else ((shape[axis] - x, shape[axis]) for x in widths)
+    vert = reference_mask_lines(shape, limits)
+    return vert.T if axis == 0 else vert
+
+def reference_mask_concave_corner(shape, v, widths):
+    centre = (v+1)/2 * (numpy.array(shape) - 1)
+    sign = numpy.sign(v)
+    ellipse = reference_trace_ellipse(centre, -sign*widths, (numpy.zeros(len(shape), int), numpy.array(shape) - 1))
+    limits = (numpy.sort([centre[1], z]) + numpy.array([0, 1]) for x, z in ellipse)
+    return reference_mask_lines(shape, limits, centre[0], -sign[0])
+
+def reference_mask_convex_corner(shape, v, widths):
+    corner = (v+1)/2 * (numpy.array(shape) - 1)
+    sign = numpy.sign(v)
+    centre = corner + sign - 2*sign*widths
+    ellipse = list(reference_trace_ellipse(centre, sign*widths, (numpy.zeros(len(shape), int), numpy.array(shape) - 1)))
+    clipped = numpy.maximum(numpy.minimum(centre, numpy.array(shape) - 1), numpy.zeros(len(shape), int))
+    limits1 = [numpy.sort([corner[1], z + sign[1]]) + numpy.array([0, 1]) for x, z in ellipse]
+    limits2 = (numpy.sort([corner[1], clipped[1]]) + numpy.array([0, 1]) for z in xrange(0, shape[0] - len(limits1)))
+    return reference_mask_lines(shape, itertools.chain(limits1, limits2), clipped[0], sign[0])
+
+def reference_make_mask(shape, edge, width, seed):
+    narrowed = int(numpy.round(width/carve.narrowing_factor))
+    straights, concave, convex = carve.get_features(edge)
+    components = vec.uniques(itertools.chain.from_iterable(vec.decompose(v) for v in itertools.chain(straights, concave, convex)))
+    
+    mask = numpy.zeros(shape, dtype=bool)
+    for v in straights:
+        base_width = narrowed if vec.inside(-v, components) else int(numpy.round(width))
+        shore = itertools.repeat(base_width) if seed is None else carve.river_shore(shape, seed, base_width, v)
+        mask |= reference_mask_edge(shape, v, shore)
+    
+    for corners, masker in ((concave, reference_mask_concave_corner), (convex, reference_mask_convex_corner)):
+        for v in corners:
+            xwidth = narrowed if vec.inside(v*numpy.array([-1,  0], int), components) else int(numpy.round(width))
+            zwidth = narrowed if vec.inside(v*numpy.array([ 0, -1], int), components) else int(numpy.round(width))
+            
+            if seed is not None and masker is reference_mask_concave_corner:
+                xwidth = carve.river_shore(shape, seed, xwidth, v*numpy.array([1, 0]))[shape[1] - 1 if v[0] > 0 else 0]
+                zwidth = carve.river_shore(shape, seed, zwidth, v*numpy.array([0, 1]))[shape[0] - 1 if v[1] > 0 else 0]
+            
+            mask |= masker(shape, v, (xwidth, zwidth))
+    
+    return mask
+
+class CarveMaskTest(unittest.TestCase):
+    shape = (16, 16)
+    widths = xrange(0, 21)
+    seeds = (None, (1234, (0, 0)), (-987654321, (-7, 12)))
+    
+    def test_all_edges(self):
+        compared = 0
+        for edge, width, seed in itertools.product(xrange(1 << len(vec.directions)), self.widths, self.seeds):
+            chunk_seed = None if seed is None else carve.ChunkSeed(*seed)
+            
+            # Some masks could not be made by the original code at all
+            try:
+                expected = reference_make_mask(self.shape, vec.mask2vecs(edge), width, chunk_seed)
+            except TypeError:
+                continue
+            
+            mask = carve.make_mask(self.shape, edge, width, chunk_seed)
+            self.assertTrue(numpy.array_equal(mask, expected),
+                            "mask differs for edge %s, width %d and seed %s" % (bin(edge), width, seed))
+            compared += 1
+        
+        self.assertTrue(compared > len(self.seeds)*len(self.widths)*200)
+    
+    def test_ellipse(self):
+        for centre, axes in itertools.product(itertools.product((0, 7, 15), repeat=2),
+                                              itertools.product(xrange(-17, 18, 3), repeat=2)):
+            expected = list(reference_trace_ellipse(numpy.array(centre), numpy.array(axes)))
+            traced = carve.trace_ellipse(numpy.array(centre), numpy.array(axes))
+            self.assertEqual(traced.tolist(), [p.tolist() for p in expected])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+""" Checks the array based chunk scans in contour against the per-chunk loops they replaced """
+
+import os, sys, shutil, tempfile, unittest, itertools
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import numpy
+from pymclevel import mclevel
+import contour, merge
+import anvil
+
+def reference_heights(block_ids, block_roles):
+    """ The original column by column height search """
+    
+    mx, mz, my = block_ids.shape
+    height = numpy.empty((mx, mz), int)
+    for x in xrange(0, mx):
+        for z in xrange(0, mz):
+            for y in xrange(my - 1, -1, -1):
+                if block_ids[x, z, y] in block_roles.terrain:
+                    height[x, z] = y
+                    break
+            else:
+                height[x, z] = -1
+    
+    return height
+
+class ContourScanTest(unittest.TestCase):
+    worlds = ('world-original', 'world-together')
+    
+    @classmethod
+    def setUpClass(cls):
+        cls.temp = tempfile.mkdtemp()
+        cls.world_dirs = dict((world, anvil.anvil_world(world, os.path.join(cls.temp, world))) for world in cls.worlds)
+        
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.temp)
+        
+    def test_region_chunks(self):
+        for world, world_dir in self.world_dirs.iteritems():
+            found = contour.region_chunks(world_dir)
+            self.assertEqual(found.shape[1], 2)
+            
+            # Every chunk a region file could hold is looked up on its own
+            level = mclevel.fromFile(world_dir, readonly=True)
+            regions = set((x // 32, z // 32) for x, z in found.tolist())
+            present = [(x, z) for rx, rz in regions
+                       for x, z in itertools.product(xrange(32*rx, 32*rx + 32), xrange(32*rz, 32*rz + 32))
+                       if level.containsChunk(x, z)]
+            
+            self.assertTrue(present, "no chunks found in %s" % world)
+            self.assertEqual(len(found), len(set(map(tuple, found.tolist()))))
+            self.assertEqual(sorted(map(tuple, found.tolist())), sorted(present))
+            self.assertEqual(sorted(present), sorted(level.allChunks))
+            
+            # The McRegion originals hold the same chunks
+            original = contour.region_chunks(os.path.join(anvil.testfiles, world))
+            self.assertEqual(sorted(map(tuple, original.tolist())), sorted(present))
+        
+    def test_find_heights(self):
+        world_dir = self.world_dirs['world-original']
+        block_roles = merge.Merger(world_dir)._Merger__block_roles
+        level = mclevel.fromFile(world_dir, readonly=True)
+        chunks = [level.getChunk(*coord).Blocks for coord in sorted(level.allChunks)]
+        self.assertTrue(chunks)
+        
+        # Add empty columns, columns of only terrain and random blocks
+        rng = numpy.random.RandomState(0)
+        blocks = chunks[0].copy()
+        blocks[:4] = 0
+        blocks[4:8] = 1
+        chunks.append(blocks)
+        chunks.append(rng.randint(0, 256, chunks[0].shape).astype(chunks[0].dtype))
+        chunks.append(rng.choice([0, 0, 0, 8, 9, 18, 31, 1], chunks[0].shape).astype(chunks[0].dtype))
+        
+        expected = [reference_heights(blocks, block_roles) for blocks in chunks]
+        self.assertTrue(any((height == -1).any() for height in expected))
+        for blocks, height in itertools.izip(chunks, expected):
+            self.assertTrue(numpy.array_equal(contour.HeightMap.find_heights(blocks, block_roles), height))
+        
+        # Chunks may also be searched all at once
+        self.assertTrue(numpy.array_equal(contour.HeightMap.find_heights(numpy.array(chunks), block_roles), numpy.array(expected)))
+
+if __name__ == '__main__':
+    unittest.main()
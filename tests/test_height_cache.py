@@ -0,0 +1,38 @@
+""" Checks the height cache file round trips and rejects damaged files """
+
+import os, sys, shutil, tempfile, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import numpy
+import contour
+
+class HeightCacheFileTest(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.temp, 'heights.dat')
+        
+        cache = contour.HeightCache()
+        cache.check(numpy.arange(256, dtype=numpy.uint8))
+        for n in xrange(4):
+            cache.put((n, -n), n*7, numpy.arange(256).reshape(16, 16) + n)
+        cache.write(self.file_name)
+        
+    def tearDown(self):
+        shutil.rmtree(self.temp)
+        
+    def test_round_trip(self):
+        cache = contour.HeightCache()
+        cache.read(self.file_name)
+        self.assertEqual(len(cache), 4)
+        self.assertTrue((cache.get((2, -2), 14) == numpy.arange(256).reshape(16, 16) + 2).all())
+        
+    def test_truncated(self):
+        with open(self.file_name, 'rb') as f:
+            data = f.read()
+        
+        for size in (0, 10, len(data) - 1):
+            with open(self.file_name, 'wb') as f:
+                f.write(data[:size])
+            self.assertRaises(contour.ContourLoadError, contour.HeightCache().read, self.file_name)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+""" Checks the light spread by the light module matches pymclevel's own lighting """
+
+import os, sys, shutil, tempfile, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from pymclevel import mclevel
+import light
+import anvil
+
+class LightTest(unittest.TestCase):
+    world = 'world-original'
+    
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+        
+        # The light pymclevel finds when relighting the whole map
+        world_dir = anvil.anvil_world(self.world, os.path.join(self.temp, 'generated'))
+        level = mclevel.fromFile(world_dir)
+        for coord in level.allChunks:
+            level.getChunk(*coord).chunkChanged()
+        level.generateLights()
+        level.saveInPlace()
+        
+        self.generated = self.lights(world_dir)
+        self.assertTrue(self.generated, "no chunks found")
+        self.assertTrue(any(skylight.any() for skylight, _ in self.generated.itervalues()), "no sky light found")
+        self.assertTrue(any(blocklight.any() for _, blocklight in self.generated.itervalues()), "no block light found")
+        
+    def tearDown(self):
+        shutil.rmtree(self.temp)
+        
+    @staticmethod
+    def lights(world_dir):
+        level = mclevel.fromFile(world_dir, readonly=True)
+        return dict((coord, (level.getChunk(*coord).SkyLight.copy(), level.getChunk(*coord).BlockLight.copy()))
+                    for coord in level.allChunks)
+        
+    def check_relit(self, world_dir, lows):
+        level = mclevel.fromFile(world_dir)
+        around = light.with_margin(level, lows)
+        self.assertEqual(light.relight(level, around), len(around))
+        level.saveInPlace()
+        
+        relit = self.lights(world_dir)
+        self.assertEqual(sorted(relit), sorted(self.generated))
+        for coord, (skylight, blocklight) in self.generated.iteritems():
+            self.assertTrue((skylight == relit[coord][0]).all(), "sky light differs in chunk %s" % (coord,))
+            self.assertTrue((blocklight == relit[coord][1]).all(), "block light differs in chunk %s" % (coord,))
+        
+    def test_whole_map(self):
+        # Every chunk relit from the bottom up starting out with the light left in the world
+        world_dir = anvil.anvil_world(self.world, os.path.join(self.temp, 'relit'))
+        self.check_relit(world_dir, dict.fromkeys(self.generated, 0))
+        
+    def test_band(self):
+        # Relighting a band of a map lit by pymclevel leaves its light as it is
+        world_dir = os.path.join(self.temp, 'band')
+        shutil.copytree(os.path.join(self.temp, 'generated'), world_dir)
+        coords = sorted(self.generated)
+        self.check_relit(world_dir, dict((coord, 40 + 3*n) for n, coord in enumerate(coords[::2])))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+""" Checks everything handed to merge worker processes survives pickling """
+
+import os, sys, shutil, tempfile, unittest, pickle
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import numpy
+import merge
+
+testfiles = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'testfiles')
+
+class WorkerArgsTest(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+        world_dir = os.path.join(self.temp, 'world')
+        shutil.copytree(os.path.join(testfiles, 'world-together'), world_dir)
+        self.merger = merge.Merger(world_dir)
+        
+    def tearDown(self):
+        merge._worker = None
+        shutil.rmtree(self.temp)
+        
+    def test_pickle_init_args(self):
+        # Spawned workers (as on Windows) receive their setup arguments pickled
+        args = self.merger._Merger__worker_args()
+        for protocol in xrange(pickle.HIGHEST_PROTOCOL + 1):
+            merge._init_worker(*pickle.loads(pickle.dumps(args, protocol)))
+            
+            world, block_roles = merge._worker
+            self.assertEqual(world.RandomSeed, args[0].RandomSeed)
+            self.assertEqual(block_roles._fields, args[1]._fields)
+            self.assertEqual(block_roles.tables._fields, args[1].tables._fields)
+            for name, table in zip(block_roles.tables._fields, block_roles.tables):
+                self.assertTrue(numpy.array_equal(table, getattr(args[1].tables, name)), "table %s differs" % name)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+""" Checks relighting in parallel gives the same light as pymclevel relighting the whole map at once """
+
+import os, sys, shutil, tempfile, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from pymclevel import mclevel
+import various
+import anvil
+
+class ParallelRelightTest(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+        
+    def tearDown(self):
+        various.Relighter.jobs = 1
+        shutil.rmtree(self.temp)
+        
+    def relit(self, world, jobs):
+        """ Relights an Anvil copy of a test world, returns the light of each chunk """
+        
+        world_dir = anvil.anvil_world(world, os.path.join(self.temp, '%s-%d' % (world, jobs)))
+        
+        various.Relighter.jobs = jobs
+        relight = various.Relighter(world_dir)
+        relit = relight.relight()
+        relight.commit()
+        
+        level = mclevel.fromFile(world_dir, readonly=True)
+        chunks = list(level.allChunks)
+        self.assertEqual(relit, len(chunks))
+        return dict((coord, (level.getChunk(*coord).SkyLight.copy(), level.getChunk(*coord).BlockLight.copy()))
+                    for coord in chunks)
+        
+    def check_world(self, world, chunks):
+        serial = self.relit(world, 1)
+        parallel = self.relit(world, 3)
+        
+        # Make sure the world was actually read
+        self.assertEqual(len(serial), chunks)
+        self.assertTrue(any(skylight.any() for skylight, _ in serial.itervalues()), "no sky light found")
+        
+        self.assertEqual(sorted(serial), sorted(parallel))
+        for coord, (skylight, blocklight) in serial.iteritems():
+            self.assertTrue((skylight == parallel[coord][0]).all(), "sky light differs in chunk %s" % (coord,))
+            self.assertTrue((blocklight == parallel[coord][1]).all(), "block light differs in chunk %s" % (coord,))
+        
+    def test_world_original(self):
+        self.check_world('world-original', 40)
+        
+    def test_world_together(self):
+        self.check_world('world-together', 1474)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+"""
+Checks ChunkShaper.remove against a corpus of chunks eroded by the
+original block by block implementation. Blocks are recorded by name
+so the corpus applies whatever block IDs the materials give them.
+"""
+
+import os, sys, shutil, tempfile, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import numpy
+from pymclevel import mclevel
+import merge
+from contour import EdgeData
+import anvil
+
+corpus = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'remove_corpus.npz')
+
+class RemoveCorpusTest(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+        world_dir = anvil.anvil_world('world-original', os.path.join(self.temp, 'world'))
+        self.block_roles = merge.Merger(world_dir)._Merger__block_roles
+        self.materials = mclevel.fromFile(world_dir, readonly=True).materials
+        
+    def tearDown(self):
+        shutil.rmtree(self.temp)
+        
+    def palette(self, names, data):
+        """ Block IDs of the named blocks in the level materials """
+        
+        blocks = {}
+        for block in self.materials:
+            blocks.setdefault(block.name, block)
+            for alt in (x.strip() for x in block.aka.split(',')):
+                blocks.setdefault(alt, block)
+        
+        for name, block_data in zip(names, data):
+            self.assertIn(name, blocks)
+            self.assertEqual(blocks[name].blockData, block_data, "%s has unexpected block data" % name)
+        return numpy.array([blocks[name].ID for name in names])
+        
+    def test_corpus(self):
+        cases = numpy.load(corpus)
+        ids = self.palette(cases['palette'], cases['palette_data'])
+        world = merge.DetachedWorld(0, self.materials)
+        
+        fields = ('blocks', 'data', 'smoothed', 'valley', 'settings', 'expected_blocks', 'expected_data')
+        self.assertTrue(len(cases['blocks']) > 0)
+        for n, (blocks, data, smoothed, valley, settings, expected_blocks, expected_data) in \
+                enumerate(zip(*[cases[field] for field in fields])):
+            shift_depth, sea_level, desert, ocean, dry, has_valley, _ = settings
+            
+            chunk = merge.DetachedChunk(world, (0, 0), ids[blocks].astype(numpy.uint16), data.copy())
+            cs = merge.ChunkShaper(chunk, EdgeData(0, 0), 1, None, self.block_roles)
+            cs.shift_depth = shift_depth
+            cs.sea_level = sea_level
+            cs._ChunkShaper__desert, cs._ChunkShaper__ocean, cs._ChunkShaper__dry = bool(desert), bool(ocean), bool(dry)
+            cs.remove(smoothed, valley if has_valley else None)
+            
+            self.assertTrue((chunk.Blocks == ids[expected_blocks]).all(), "blocks differ in case %d" % n)
+            self.assertTrue((chunk.Data == expected_data).all(), "block data differs in case %d" % n)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,20 @@
-import itertools
-import numpy
+import itertools, multiprocessing
 from pymclevel import mclevel
+import light
+
+_relighter = None
+
+def _init_relighter(world_dir):
+    """ Sets up a worker process reading the world for relighting chunks """
+    
+    global _relighter
+    
+    _relighter = Relighter(world_dir, readonly=True)
+
+def _light_tile(tile):
+    """ Finds the light of a tile of chunks in a worker process """
+    
+    return _relighter.light_tile(tile)
 
 class Shifter(object):
     """
@@ -8,6 +22,7 @@ class Shifter(object):
     """
     
     relight = True
+    patch_light = False # Patch the light in the gaps and only relight chunks bordering differently shifted ones
     
     def __init__(self, world_dir):
         self.__level = mclevel.fromFile(world_dir)
@@ -26,10 +41,10 @@ class Shifter(object):
             contour.shift[coord] = distance
         
     def shift_all(self, distance):
-        return self.__shift(itertools.izip(self.__level.allChunks, itertools.repeat(distance)))
+        return self.__shift(itertools.izip(self.__level.allChunks, itertools.repeat(distance)), distance)
     
     def shift_marked(self, contour):
-        return self.__shift(contour.shift.iteritems())
+        return self.__shift(contour.shift.iteritems(), 0)
     
     def __measure(self, height, distance):
         # Return memoised value
@@ -54,59 +69,124 @@ class Shifter(object):
         self.__measured = (args, (yfrom, yto, ybuffer))
         
         return self.__measured[1]
+    
+    @staticmethod
+    def __move(arr, yfrom, yto):
+        """ Moves the layers of every column of a chunk array """
+        
+        # The columns of a contiguous array are laid out one after another so
+        # the whole array can be moved in one go, this drags layers across
+        # neighbouring columns but they all end up either in the gap or on
+        # the bottom layer, which is put back
+        if arr.flags.c_contiguous:
+            bottom = arr[:, :, 0].copy()
+            flat = arr.reshape(-1)
+            offset = yto[0] - yfrom[0]
+            if offset > 0:
+                flat[offset:] = flat[:-offset]
+            else:
+                flat[:offset] = flat[-offset:]
+            arr[:, :, 0] = bottom
+        else:
+            arr[:, :, yto[0]:yto[1]] = arr[:, :, yfrom[0]:yfrom[1]]
+        
+    def __shift(self, distances, others):
+        n, distance = self.__shift_chunks(distances, others)
+        self.__shift_players(distance)
+        
+        # Do final logging update for the end
+        if self.log_function is not None:
+            self.log_function(n)
+        
+        return n
+    
+    def __shift_chunks(self, distances, others):
+        """
+        Shifts each chunk by its distance, returns the number of
+        chunks gone through along with the last distance. Chunks
+        not listed are taken to be shifted by the 'others' distance.
+        """
         
-    def __shift(self, distances):
         # Prelims
-        height = self.__level.Height
+        distances = list(distances)
+        shifts = dict(distances)
+        
+        def bordering(coord):
+            """ Check if any neighbouring chunk is shifted differently """
+            
+            for x, z in itertools.product(xrange(-1, 2), xrange(-1, 2)):
+                around = (coord[0] + x, coord[1] + z)
+                if shifts.get(around, others) != shifts[coord] and self.__level.containsChunk(*around):
+                    return True
+            return False
             
         # Go through all the chunks and data provided
-        n = 0
+        n = -1; distance = 0
         for n, (coord, distance) in enumerate(distances):
-            # Get measured boundaries
+            # Unshifted chunks are left alone
             if distance == 0:
                 continue
-            else:
-                yfrom, yto, ybuffer = self.__measure(height, distance)
             
             # Progress logging
             if self.log_function is not None:
                 if n % self.log_interval == 0:
                     self.log_function(n)
             
+            # Light moves along with the blocks so when patching
+            # it only the seams between shifts need relighting
             chunk = self.__level.getChunk(*coord)
-            for arr in (chunk.Blocks, chunk.Data, chunk.BlockLight, chunk.SkyLight):
-                # Do the shifting
-                arr[:, :, yto[0]:yto[1]] = arr[:, :, yfrom[0]:yfrom[1]]
+            self.__shift_chunk(chunk, distance, not self.patch_light or bordering(coord))
+        
+        return n + 1, distance
+    
+    def __shift_chunk(self, chunk, distance, relight):
+        """ Shifts a chunk along with its entities """
+        
+        self.__shift_arrays((chunk.Blocks, chunk.Data, chunk.BlockLight, chunk.SkyLight), distance)
+        
+        # Shift all entity positions
+        for entity in chunk.Entities:
+            entity['Pos'][1].value += distance
+        
+        # Shift all tile entity positions
+        for entity in chunk.TileEntities:
+            entity['y'].value += distance
             
-                # Fill in gaps
-                copy_volume = arr.shape[0]*arr.shape[1]*(ybuffer[1] - ybuffer[0])
-                copy_edges = (arr.shape[0], arr.shape[1], ybuffer[1] - ybuffer[0])
-                if distance < 0:
-                    # For top of map we want to fill with air blocks
-                    custom = ((chunk.Blocks, chunk.world.materials.Air.ID), (chunk.Blocks, chunk.world.materials.Air.blockData))
-                    for which, val in custom:
-                        if arr is which:
-                            arr[:, :, ybuffer[0]:ybuffer[1]] = numpy.fromiter(itertools.repeat(val, copy_volume), arr.dtype).reshape(copy_edges)
-                            break
-                    
-                    # Just copy the lighting data from the top most row, this is probably bad...
-                    else:
-                        arr[:, :, ybuffer[0]:ybuffer[1]] = numpy.fromiter(itertools.islice(itertools.cycle(arr[:, :, height-1:height].flatten()), copy_volume), arr.dtype).reshape(copy_edges)
+        # The chunk has changed!
+        chunk.chunkChanged(relight)
+    
+    def __shift_arrays(self, arrays, distance):
+        """
+        Shifts the block, data, block light and sky light arrays of
+        a chunk, given in that order, and fills in the gaps.
+        """
+        
+        height = self.__level.Height
+        yfrom, yto, ybuffer = self.__measure(height, distance)
+        
+        for i, arr in enumerate(arrays):
+            # Find what goes in the gaps before the shifting disturbs it
+            if distance < 0:
+                # For top of map we want to fill with air blocks
+                if i == 0:
+                    fill = self.__level.materials.Air.ID
+                
+                # Just copy the data from the top most row, this is probably bad...
                 else:
-                    # Copy all data from the bottom row
-                    arr[:, :, ybuffer[0]:ybuffer[1]] = numpy.fromiter(itertools.islice(itertools.cycle(arr[:, :, 0:1].flatten()), copy_volume), arr.dtype).reshape(copy_edges)
-                        
-            # Shift all entity positions
-            for entity in chunk.Entities:
-                entity['Pos'][1].value += distance
+                    fill = arr[:, :, height-1:height].copy()
+            else:
+                # Copy all data from the bottom row
+                fill = arr[:, :, 0:1].copy()
             
-            # Shift all tile entity positions
-            for entity in chunk.TileEntities:
-                entity['y'].value += distance
-                
-            # The chunk has changed!
-            chunk.chunkChanged()
-        
+            # The top of the map is open to the sky
+            if self.patch_light and distance < 0 and i >= 2:
+                fill = (0, 15)[i - 2]
+            
+            # Do the shifting and fill in gaps
+            self.__move(arr, yfrom, yto)
+            arr[:, :, ybuffer[0]:ybuffer[1]] = fill
+    
+    def __shift_players(self, distance):
         def shiftY(coord, distance):
             return [coord[0], coord[1] + distance, coord[2]]
         
@@ -118,12 +198,6 @@ class Shifter(object):
         # Shift default spawn position
         self.__level.setPlayerSpawnPosition(shiftY(self.__level.playerSpawnPosition(), distance))
         
-        # Do final logging update for the end
-        if self.log_function is not None:
-            self.log_function(n + 1)
-        
-        return n + 1
-        
     def commit(self):
         """ Finalise and save map """
         
@@ -137,8 +211,12 @@ class Relighter(object):
     after making alterations to the map.
     """
     
-    def __init__(self, world_dir):
-        self.__level = mclevel.fromFile(world_dir)
+    jobs = 1            # Number of worker processes finding the light of tiles of chunks
+    region_size = 32    # Width of a region file in chunks
+    
+    def __init__(self, world_dir, readonly=False):
+        self.__world_dir = world_dir
+        self.__level = mclevel.fromFile(world_dir, readonly=readonly)
         
         self.log_interval = 1
         self.log_function = None
@@ -148,6 +226,9 @@ class Relighter(object):
         return self.__level
     
     def relight(self):
+        if self.jobs > 1:
+            return self.__relight_tiles()
+        
         # Go through all chunks
         n = 0
         for n, coord in enumerate(self.__level.allChunks):
@@ -167,6 +248,65 @@ class Relighter(object):
         self.__level.generateLights()
         
         return n + 1
+    
+    def __relight_tiles(self):
+        """
+        Has pymclevel light tiles of chunks in worker processes which
+        only read the world, the light found is put back here.
+        """
+        
+        # Tiles are gone through a region at a time so their light is put back region by region
+        tiles = light.tiles(self.__level.allChunks)
+        tiles.sort(key=lambda tile: (tile[0][0] // self.region_size, tile[0][1] // self.region_size))
+        
+        pool = multiprocessing.Pool(self.jobs, _init_relighter, (self.__world_dir,))
+        try:
+            n = 0
+            for i, tile_lights in enumerate(pool.imap(_light_tile, tiles)):
+                # Progress logging
+                if self.log_function is not None:
+                    if i % self.log_interval == 0:
+                        self.log_function(n)
+                
+                for coord, (skylight, blocklight) in tile_lights.iteritems():
+                    chunk = self.__level.getChunk(*coord)
+                    chunk.SkyLight[:] = skylight
+                    chunk.BlockLight[:] = blocklight
+                    chunk.dirty = True
+                n += len(tile_lights)
+            
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        
+        # Do final logging update for the end
+        if self.log_function is not None:
+            self.log_function(n)
+        
+        return n
+    
+    def light_tile(self, tile):
+        """
+        Has pymclevel light a tile of chunks along with the chunks
+        all around it and returns the light of the tile's chunks. No
+        light travels further than a chunk, so the tile is lit just
+        as if the whole map was. Everything loaded is let go of
+        afterwards, meant for levels that are only read.
+        """
+        
+        around = light.with_margin(self.__level, dict.fromkeys(tile, 0))
+        for coord in around:
+            self.__level.getChunk(*coord).chunkChanged()
+        self.__level.generateLights(around.keys())
+        
+        lights = {}
+        for coord in tile:
+            chunk = self.__level.getChunk(*coord)
+            lights[coord] = (chunk.SkyLight.copy(), chunk.BlockLight.copy())
+        
+        self.__level.unload()
+        return lights
         
     def commit(self):
         """ Finalise and save map """
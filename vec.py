@@ -35,3 +35,28 @@ def tuples2vecs(tuples):
     
     return [numpy.array(t) for t in tuples]
 
+# Offsets to all the surrounding cells, direction masks have a bit
+# for each of these in the same order
+directions = tuple((x, z) for z in xrange(-1, 2) for x in xrange(-1, 2) if z != 0 or x != 0)
+
+_mask_directions = [frozenset(d for i, d in enumerate(directions) if mask & (1 << i)) for mask in xrange(0, 1 << len(directions))]
+
+def dirs2mask(dirs):
+    """ Convert set of direction tuples into a direction mask """
+    
+    return sum(1 << directions.index(d) for d in set(dirs))
+
+def mask2dirs(mask):
+    """ Convert direction mask into set of direction tuples """
+    
+    return set(_mask_directions[mask])
+
+def dir2bit(v):
+    """ Direction mask bit of a single direction vector """
+    
+    return 1 << directions.index(tuple(v))
+
+def mask2vecs(mask):
+    """ Convert direction mask into list of vectors """
+    
+    return [numpy.array(d) for i, d in enumerate(directions) if mask & (1 << i)]